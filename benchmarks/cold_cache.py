@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Counts the cache round trips of selects against an empty cache, as after a
+flush or an eviction, with and without skipping the result lookup when a
+table's generation has just been created.  Each round trip waits a while,
+as it would across a network, and the database is in memory.
+"""
+
+import time
+
+import common
+
+from django.conf import settings
+settings.DATABASES['default']['NAME'] = ':memory:'
+settings.INSTALLED_APPS = tuple(settings.INSTALLED_APPS) + (
+    'johnny.tests.testapp',)
+
+from django.core.management import call_command
+from django.db.models.loading import load_app
+
+from johnny.backends.locmem import LocMemCache
+from johnny.cache import QueryCacheBackend, KeyHandler
+
+LATENCY = 0.0005
+
+
+class RoundTripCache(LocMemCache):
+    """Counts the requests made to it, each of which takes ``LATENCY``."""
+
+    round_trips = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        time.sleep(LATENCY)
+
+    def get(self, *args, **kwargs):
+        self._round_trip()
+        return super(RoundTripCache, self).get(*args, **kwargs)
+
+    def get_many(self, *args, **kwargs):
+        self._round_trip()
+        return super(RoundTripCache, self).get_many(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        self._round_trip()
+        return super(RoundTripCache, self).set(*args, **kwargs)
+
+    def set_many(self, *args, **kwargs):
+        self._round_trip()
+        return super(RoundTripCache, self).set_many(*args, **kwargs)
+
+
+class LookupAlwaysKeyHandler(KeyHandler):
+    """Never reports a new generation, so results are always looked up."""
+
+    def get_generation_info(self, *tables, **kwargs):
+        generation = KeyHandler.get_generation_info(self, *tables, **kwargs)[0]
+        return generation, False
+
+
+def querysets():
+    from johnny.tests.testapp.models import (Genre, Book, Publisher, Person,
+                                             User)
+    return [Genre.objects.all(), Book.objects.filter(publisher__isnull=False),
+            Publisher.objects.all(), Person.objects.all(),
+            User.objects.all()]
+
+
+def cold_pass(backend, cache):
+    cache.clear()
+    backend.cache_backend.clear()
+    cache.round_trips = 0
+    t0 = time.time()
+    for qs in querysets():
+        list(qs)
+    return cache.round_trips, time.time() - t0
+
+
+def main():
+    load_app('johnny.tests.testapp')
+    call_command('syncdb', verbosity=0, interactive=False)
+    rows = []
+    for name, keyhandler in (('lookup always', LookupAlwaysKeyHandler),
+                             ('skip if new', KeyHandler)):
+        cache = RoundTripCache('cold-cache', {})
+        backend = QueryCacheBackend(cache_backend=cache,
+                                    keyhandler=keyhandler)
+        backend.patch()
+        try:
+            runs = [cold_pass(backend, cache) for i in range(20)]
+        finally:
+            backend.unpatch()
+        rows.append((name, runs[0][0], min(t for n, t in runs)))
+    common.report('%d selects on a cold cache' % len(querysets()),
+                  ('', 'round trips', 'time'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Shared setup for the johnny-cache benchmarks.  These are plain scripts meant
+to be run from the root of the repository against the bundled test settings,
+for example::
+
+    python benchmarks/transaction_depth.py
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+
+def best_of(func, number=1000, repeat=5):
+    """Returns the best average time, in seconds, of ``number`` calls to
+    ``func`` over ``repeat`` runs."""
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        for j in xrange(number):
+            func()
+        elapsed = (time.time() - t0) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(title, headers, rows):
+    """Prints a simple table of benchmark results."""
+    print title
+    widths = [max(len(str(h)), 12) for h in headers]
+    print '  '.join(str(h).rjust(w) for h, w in zip(headers, widths))
+    for row in rows:
+        cells = []
+        for value, w in zip(row, widths):
+            if isinstance(value, float):
+                value = '%.2fus' % (value * 1e6)
+            cells.append(str(value).rjust(w))
+        print '  '.join(cells)
+    print
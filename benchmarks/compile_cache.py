@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Times compiling testapp queries the way a cache hit has to before it can
+look its result up:  with ``as_sql()``, and with ``CompiledQueries``, which
+compiles a query once per shape and afterwards only collects the values of
+its conditions.  Each query is compiled from a fresh clone, as a new queryset
+would be, but only the compiling is timed.
+"""
+
+import time
+
+import common
+
+from django.conf import settings
+settings.INSTALLED_APPS = tuple(settings.INSTALLED_APPS) + (
+    'johnny.tests.testapp',)
+
+from johnny.cache import CompiledQueries
+
+
+def querysets():
+    from django.db.models import Q
+    from johnny.tests.testapp.models import Genre, Book
+    return [
+        ('all', Genre.objects.all()),
+        ('pk', Genre.objects.filter(pk=1)),
+        ('filter + order', Genre.objects.filter(
+            title__startswith='A').order_by('-slug')),
+        ('join + slice', Book.objects.exclude(publisher__title='A')[10:20]),
+        ('or of 4', Book.objects.filter(
+            Q(title='A') | Q(slug__icontains='a') | Q(pages__gt=10) |
+            Q(isbn__in=['1', '2', '3']))),
+    ]
+
+
+def time_compile(query, compile, number=1000, repeat=5):
+    """Like ``common.best_of``, for calls of ``compile`` on compilers of
+    fresh clones of ``query``."""
+    best = None
+    for i in range(repeat):
+        compilers = [query.clone().get_compiler('default')
+                     for j in xrange(number)]
+        t0 = time.time()
+        for compiler in compilers:
+            compile(compiler)
+        elapsed = (time.time() - t0) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    rows = []
+    for name, qs in querysets():
+        query = qs.query
+        compiled = CompiledQueries(1000)
+        compiled.compile(query.clone().get_compiler('default'))
+        as_sql = time_compile(query, lambda compiler: compiler.as_sql())
+        cached = time_compile(query, compiled.compile)
+        rows.append((name, as_sql, cached, '%.1fx' % (as_sql / cached)))
+    common.report('compiling a query', ('', 'as_sql', 'cached', 'speedup'),
+                  rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Compares ways of fetching keys spread over several memcached servers with
+python-memcached, against local stand-ins for memcached servers that wait a
+while before answering each request, the way servers across a network would:
+
+* ``get_many``:  johnny's ``MemcachedCache.get_many``, which is a single
+  ``get_multi`` that sends every server its request before reading any of
+  the responses.
+* ``sequential``:  one ``get_multi`` per server, one after another.
+* ``threads=N``:  one ``get_multi`` per server from a pool of N threads.
+  Each stand-in runs in a process of its own so
+that they don't compete with each other or the client for the GIL.
+"""
+
+import os
+import signal
+import SocketServer
+import time
+from multiprocessing.pool import ThreadPool
+
+import common
+
+from johnny.backends.memcached import MemcachedCache
+
+SERVERS = 12
+KEYS = 120
+THREADS = (4, 12)
+LATENCIES = (0.0005, 0.002)
+VALUE_SIZES = (32, 16 * 1024)
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """Speaks just enough of memcached's text protocol for ``set`` and
+    ``get``."""
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if parts[0] == 'set':
+                key, flags, exptime, length = parts[1:5]
+                data[key] = (flags, self.rfile.read(int(length) + 2)[:-2])
+                self.wfile.write('STORED\r\n')
+            elif parts[0] in ('get', 'gets'):
+                time.sleep(self.server.latency)
+                out = []
+                for key in parts[1:]:
+                    if key in data:
+                        flags, value = data[key]
+                        out.append('VALUE %s %s %d\r\n%s\r\n'
+                                   % (key, flags, len(value), value))
+                out.append('END\r\n')
+                self.wfile.write(''.join(out))
+            else:
+                self.wfile.write('ERROR\r\n')
+            self.wfile.flush()
+
+
+class MemcachedServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 MemcachedHandler)
+        self.latency = latency
+        self.data = {}
+
+
+def start_servers(count, latency):
+    """Starts ``count`` stand-in servers, each in a process of its own.
+    Returns their pids and location for the cache backend."""
+    pids, addresses = [], []
+    for i in range(count):
+        server = MemcachedServer(latency)
+        pid = os.fork()
+        if not pid:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        server.socket.close()
+        pids.append(pid)
+        addresses.append('127.0.0.1:%d' % server.server_address[1])
+    return pids, ';'.join(addresses)
+
+
+def group_by_server(cache, keys):
+    client = cache._cache
+    groups = {}
+    for key in keys:
+        server, key = client._get_server(cache.make_key(key))
+        groups.setdefault(server.address, []).append(key)
+    return groups.values()
+
+
+def main():
+    rows = []
+    for latency in LATENCIES:
+        pids, location = start_servers(SERVERS, latency)
+        cache = MemcachedCache(location, {})
+        pools = dict((threads, ThreadPool(threads)) for threads in THREADS)
+        for size in VALUE_SIZES:
+            keys = ['jc_default_table_%d' % i for i in range(KEYS)]
+            cache.set_many(dict((key, 'x' * size) for key in keys), 0)
+            assert len(cache.get_many(keys)) == KEYS
+            groups = group_by_server(cache, keys)
+            # python-memcached's clients are thread-local, so the threads
+            # of the pools each have their own connections
+            get_multi = lambda keys: cache._cache.get_multi(keys)
+            row = ['%.1fms' % (latency * 1000), size]
+            row.append(common.best_of(lambda: cache.get_many(keys), number=20))
+            row.append(common.best_of(lambda: map(get_multi, groups),
+                                      number=20))
+            for threads in THREADS:
+                pool = pools[threads]
+                row.append(common.best_of(lambda: pool.map(get_multi, groups),
+                                          number=20))
+            rows.append(row)
+        for pool in pools.values():
+            pool.terminate()
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+    common.report('get_many of %d keys over %d servers' % (KEYS, SERVERS),
+                  ['latency', 'value size', 'get_many', 'sequential'] +
+                  ['threads=%d' % t for t in THREADS], rows)
+
+
+if __name__ == '__main__':
+    main()
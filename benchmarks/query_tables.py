@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Times finding the tables of testapp queries with nested subselects, by
+walking the query with ``get_tables_for_query`` as every execution used to
+and by looking the tables of its sql up in ``johnny.cache.query_tables``,
+as executions of a statement after its first one do now.
+"""
+
+import common
+
+from django.conf import settings
+settings.INSTALLED_APPS = tuple(settings.INSTALLED_APPS) + (
+    'johnny.tests.testapp',)
+
+from johnny.cache import get_tables_for_query, QueryTables
+
+
+def querysets():
+    from johnny.tests.testapp.models import (Genre, Book, Publisher, Person,
+                                             User, Highlight)
+    users = User.objects.filter(username__startswith='a')
+    people = Person.objects.filter(user__in=users)
+    books = Book.objects.filter(authors__in=people)
+    return [
+        ('no subselect', Genre.objects.filter(title__startswith='A')),
+        ('1 subselect', Book.objects.filter(
+            publisher__in=Publisher.objects.filter(title__startswith='A'))),
+        ('2 subselects', books),
+        ('3 subselects', Highlight.objects.filter(book__in=books)),
+        ('3 + joins', Highlight.objects.filter(
+            book__in=books, book__genre__title__startswith='A',
+            user__in=users)),
+    ]
+
+
+def main():
+    rows = []
+    for name, qs in querysets():
+        query = qs.query
+        sql = query.get_compiler('default').as_sql()[0]
+        query_tables = QueryTables(1000)
+        query_tables.get(query, sql)
+        rows.append((name, len(get_tables_for_query(query)),
+                     common.best_of(lambda: get_tables_for_query(query)),
+                     common.best_of(lambda: query_tables.get(query, sql))))
+    common.report('finding the tables of a query',
+                  ('', 'tables', 'walk', 'memo'), rows)
+
+
+if __name__ == '__main__':
+    main()
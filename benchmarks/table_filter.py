@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Times deciding whether the tables of a query are left out of the cache, for
+lists of different sizes:  with the set operations that ``disallowed_table``
+used to do for every query, or for glob patterns by matching them against
+every table, and with ``TableFilter``, which remembers its decision for each
+tuple of tables.
+"""
+
+import fnmatch
+
+import common
+
+from django.conf import settings
+settings.INSTALLED_APPS = tuple(settings.INSTALLED_APPS) + (
+    'johnny.tests.testapp',)
+
+from johnny import settings as johnny_settings
+from johnny.cache import TableFilter
+
+TABLES = [('testapp_genre',),
+          ('testapp_book', 'testapp_publisher', 'testapp_book_genre'),
+          ('testapp_book', 'testapp_publisher', 'testapp_book_genre',
+           'testapp_person', 'testapp_book_authors', 'testapp_user')]
+
+
+def set_disallowed(*tables):
+    return not bool(johnny_settings.WHITELIST.issuperset(tables)) \
+        if johnny_settings.WHITELIST \
+        else bool(johnny_settings.BLACKLIST.intersection(tables))
+
+
+def glob_disallowed(*tables):
+    return any([fnmatch.fnmatchcase(table, pattern)
+                for table in tables for pattern in johnny_settings.BLACKLIST])
+
+
+def main():
+    many = set(['other_table_%d' % i for i in range(50)])
+    globs = set(['other_%d_*' % i for i in range(10)])
+    rows = []
+    for name, blacklist, whitelist, naive in (
+            ('no lists', set(), set(), set_disallowed),
+            ('50 black', many, set(), set_disallowed),
+            ('50 white', set(),
+             many | set(['testapp_%s' % t for t in ('genre', 'book')]),
+             set_disallowed),
+            ('10 globs', globs, set(), glob_disallowed)):
+        johnny_settings.BLACKLIST = blacklist
+        johnny_settings.WHITELIST = whitelist
+        table_filter = TableFilter()
+        table_filter.prepare()
+        for tables in TABLES:
+            rows.append((name, len(tables),
+                         common.best_of(lambda: naive(*tables)),
+                         common.best_of(
+                             lambda: table_filter.disallowed(tables))))
+    common.report('deciding whether tables are cached',
+                  ('', 'tables', 'per query', 'TableFilter'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Times TransactionCache operations as the savepoint depth grows.  Lookups,
+writes and savepoint rollbacks should cost the same at any depth.
+"""
+
+import common
+
+from django.core.cache.backends.locmem import LocMemCache
+from johnny.transaction import TransactionCache
+
+DEPTHS = (0, 1, 2, 5, 10, 20, 50)
+KEYS = 20
+
+
+def nested_cache(depth):
+    backend = LocMemCache('transaction-depth', {})
+    backend.clear()
+    for i in range(KEYS):
+        backend.set('read%d' % i, i)
+    cache = TransactionCache(backend)
+    cache.get_many(['read%d' % i for i in range(KEYS)])
+    for i in range(KEYS):
+        cache.set('dirty%d' % i, i)
+    for level in range(depth):
+        cache.savepoint('sp%d' % level)
+        cache.set('level%d' % level, level)
+    return cache
+
+
+def main():
+    rows = []
+    for depth in DEPTHS:
+        cache = nested_cache(depth)
+        keys = ['read%d' % i for i in range(KEYS)]
+
+        def savepoint_rollback():
+            cache.savepoint('bench')
+            cache.set('dirty0', 'x')
+            cache.rollback_savepoint('bench')
+
+        rows.append((
+            depth,
+            common.best_of(lambda: cache.get('read0')),
+            common.best_of(lambda: cache.get('dirty0')),
+            common.best_of(lambda: cache.get_many(keys), number=200),
+            common.best_of(lambda: cache.set('dirty1', 1)),
+            common.best_of(savepoint_rollback),
+        ))
+    common.report(
+        'TransactionCache operations by savepoint depth',
+        ('depth', 'get (read)', 'get (dirty)', 'get_many(%d)' % KEYS,
+         'set', 'sp rollback'),
+        rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,12 @@ Infinite caching memcached class.  Caches forever when passed a timeout
 of 0.  For Django >= 1.3, this module also provides ``MemcachedCache`` and
 ``PyLibMCCache``, which use the backends of their respective analogs in
 django's default backend modules.
+
+Both clients already overlap the round trips of a ``get_many`` whose keys
+hash to different servers:  python-memcached sends every server its request
+before reading any of the responses, and pylibmc does the same within
+libmemcached.  ``benchmarks/memcached_get_many.py`` compares this with
+fetching from each server in turn or from a pool of threads.
 """
 
 import logging
@@ -0,0 +1,176 @@
+"""
+A redis cache backend built directly on ``redis-py`` rather than on
+``django-redis-cache``, which uses redis features johnny can benefit from:
+
+* ``set_many``, which johnny uses to write out a transaction's changes on
+  commit, sends all of its ``SET`` commands in a single pipeline, and
+  ``delete_many`` is a single ``DEL``.
+* ``get_or_add_many`` creates missing table generations with ``SET NX``,
+  so that when several processes create the same generation at once they
+  all end up using the same one.
+* ``incr`` and ``decr`` are a single atomic script that only runs
+  ``INCRBY`` on keys that exist, so a missing key isn't recreated without
+  its expiry.
+
+Like johnny's other backends, a timeout of 0 caches forever.  Example::
+
+    CACHES = {
+        'johnny': {
+            'BACKEND': 'johnny.backends.redis_native.RedisCache',
+            'LOCATION': 'localhost:6379',
+            'OPTIONS': {'DB': 0},
+            'JOHNNY_CACHE': True,
+        }
+    }
+
+``LOCATION`` can also be the path to a unix socket.  The ``OPTIONS`` are
+``DB`` and ``PASSWORD``.
+"""
+from __future__ import absolute_import
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache.backends.base import BaseCache
+
+# INCRBY, but only on a key that exists;  nil otherwise
+INCR_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incrby', KEYS[1], ARGV[1])
+end
+"""
+
+class RedisCache(BaseCache):
+
+    def __init__(self, server, params):
+        super(RedisCache, self).__init__(params)
+        self.server = server
+        self.options = params.get('OPTIONS', {})
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            kwargs = {
+                'db': self.options.get('DB', 0),
+                'password': self.options.get('PASSWORD'),
+            }
+            if ':' in self.server:
+                host, port = self.server.rsplit(':', 1)
+                kwargs.update(host=host, port=int(port))
+            else:
+                kwargs['unix_socket_path'] = self.server
+            self._client = redis.StrictRedis(**kwargs)
+        return self._client
+
+    def _key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        # 0 means forever, which is what redis does without an expiry
+        return timeout or None
+
+    def _pack(self, value):
+        # integers are stored as they are so that INCRBY works on them
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            return str(value)
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _unpack(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return pickle.loads(value)
+
+    def add(self, key, value, timeout=None, version=None):
+        return bool(self.client.set(self._key(key, version), self._pack(value),
+                                    ex=self._timeout(timeout), nx=True))
+
+    def get(self, key, default=None, version=None):
+        value = self.client.get(self._key(key, version))
+        if value is None:
+            return default
+        return self._unpack(value)
+
+    def set(self, key, value, timeout=None, version=None):
+        self.client.set(self._key(key, version), self._pack(value),
+                        ex=self._timeout(timeout))
+
+    def delete(self, key, version=None):
+        self.client.delete(self._key(key, version))
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self._key(key, version) for key in keys])
+        return dict([(key, self._unpack(value))
+                     for key, value in zip(keys, values)
+                     if value is not None])
+
+    def has_key(self, key, version=None):
+        return self.client.exists(self._key(key, version))
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        value = self.client.eval(INCR_SCRIPT, 1, key, delta)
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version)
+
+    def set_many(self, data, timeout=None, version=None):
+        if not data:
+            return
+        timeout = self._timeout(timeout)
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in data.iteritems():
+            pipeline.set(self._key(key, version), self._pack(value),
+                         ex=timeout)
+        pipeline.execute()
+
+    def delete_many(self, keys, version=None):
+        keys = [self._key(key, version) for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def get_or_add_many(self, data, timeout=None, version=None):
+        """
+        Stores the values in ``data`` for the keys that don't exist yet,
+        and returns the values all of its keys hold afterwards, in a single
+        round trip.
+        """
+        keys = list(data)
+        if not keys:
+            return {}
+        timeout = self._timeout(timeout)
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            redis_key = self._key(key, version)
+            pipeline.set(redis_key, self._pack(data[key]), ex=timeout, nx=True)
+            pipeline.get(redis_key)
+        replies = pipeline.execute()
+        results = {}
+        for key, value in zip(keys, replies[1::2]):
+            # only None if the key was deleted again in between
+            if value is None:
+                results[key] = data[key]
+            else:
+                results[key] = self._unpack(value)
+        return results
+
+    def clear(self):
+        self.client.flushdb()
+
+    def close(self, **kwargs):
+        if self._client is not None:
+            self._client.connection_pool.disconnect()
@@ -1,7 +1,10 @@
 """Johnny's main caching functionality."""
 
+import fnmatch
 import re
 import time
+import threading
+from contextlib import contextmanager
 from uuid import uuid4
 
 try:
@@ -12,6 +15,7 @@ except ImportError:
 import localstore
 import signals
 from johnny import settings
+from johnny.datastructures import LRUCache
 from johnny.decorators import wraps, available_attrs
 from transaction import TransactionManager
 
@@ -19,7 +23,10 @@ import django
 from django.db import models
 from django.core.exceptions import ImproperlyConfigured
 from django.db.models.signals import post_save, post_delete
+from django.db.models.fields import Field
 from django.db.models.sql import compiler
+from django.db.models.sql.where import WhereNode, Constraint
+from django.utils.datastructures import SortedDict
 
 try:
     any
@@ -38,6 +45,136 @@ class NotInCache(object):
 no_result_sentinel = "22c52d96-156a-4638-a38d-aae0051ee9df"
 local = localstore.LocalStore()
 
+
+class _Flight(object):
+    """A single in-progress execution that other threads can wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
+        self.result = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent executions of the same query within a process.
+    The first thread to miss on a key runs the query; any other thread
+    missing on the same key while it runs waits for, and shares, its result.
+    If the running thread fails, the waiting threads run the query
+    themselves.
+
+    ``executed`` counts the queries that actually ran, and ``coalesced``
+    the ones that were answered by another thread's execution.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.executed += 1
+        finally:
+            self.lock.release()
+
+        if not leader:
+            flight.done.wait()
+            if flight.failed:
+                return func()
+            self.lock.acquire()
+            try:
+                self.coalesced += 1
+            finally:
+                self.lock.release()
+            return flight.result
+
+        try:
+            flight.result = func()
+        except:
+            flight.failed = True
+            raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.flights[key]
+            finally:
+                self.lock.release()
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        """Returns the executed and coalesced counters as a dict."""
+        return {'executed': self.executed, 'coalesced': self.coalesced}
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.executed = self.coalesced = 0
+        finally:
+            self.lock.release()
+
+single_flight = SingleFlight()
+
+
+class Speculation(object):
+    """
+    Remembers the generation this process last saw for each table, so that
+    the result a query would be cached under with those generations can be
+    fetched along with the tables' actual generations in one round trip.
+    The result is only used if the generations turn out to be the same.
+
+    ``hits`` counts the guesses that were right and ``misses`` the ones
+    that weren't, each of which costs a second round trip.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def guess(self, keys):
+        """Returns the generations last seen for the table ``keys``, or
+        None if any of them hasn't been seen."""
+        generations = self.generations
+        guess = [generations.get(key) for key in keys]
+        if None in guess:
+            return None
+        return guess
+
+    def update(self, generations):
+        self.generations.update(generations)
+
+    def record(self, hit):
+        self.lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Returns the hit and miss counters and the hit rate as a dict."""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': total and float(self.hits) / total or 0.0}
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.hits = self.misses = 0
+            self.generations.clear()
+        finally:
+            self.lock.release()
+
+speculation = Speculation()
+
 def empty_iter():
     #making this a function as the empty_iter has changed between 1.4 and 1.5
     if django.VERSION[:2] >= (1, 5):
@@ -46,16 +183,99 @@ def empty_iter():
         return compiler.empty_iter()
 
 
+class TableFilter(object):
+    """
+    Decides which tables ``MAN_IN_BLACKLIST`` or ``JOHNNY_TABLE_WHITELIST``
+    leave out of the cache.  Their entries can be table names, glob patterns
+    such as ``'django_*'``, or app labels such as ``'auth.*'``, which stand
+    for the tables of all of the app's models.
+
+    ``prepare`` resolves the lists once, deciding for the table of every
+    installed model up front, and the decisions for each tuple of tables
+    asked about are remembered.  Both are made again whenever what the lists
+    in ``johnny.settings`` hold changes, whether they are replaced or
+    changed in place.
+    """
+    max_decisions = 10000
+
+    def __init__(self):
+        self.state = None
+
+    def prepare(self):
+        blacklist = frozenset(settings.BLACKLIST)
+        whitelist = frozenset(settings.WHITELIST)
+        whitelisting = bool(whitelist)
+        names, patterns = self._resolve(whitelist or blacklist)
+        tables = {}
+        for model in models.get_models(include_auto_created=True):
+            table = model._meta.db_table
+            tables[table] = self._classify(table, whitelisting, names,
+                                           patterns)
+        # replaced in one go, so that other threads never see a mix of the
+        # old and the new lists
+        self.state = (blacklist, whitelist, whitelisting, names, patterns,
+                      tables, {})
+
+    def _resolve(self, entries):
+        names, patterns = set(), []
+        for entry in entries:
+            if entry.endswith('.*') and not re.search(r'[*?[]', entry[:-2]):
+                app = models.get_app(entry[:-2])
+                names.update([model._meta.db_table for model in
+                              models.get_models(app, include_auto_created=True)])
+            elif re.search(r'[*?[]', entry):
+                patterns.append(re.compile(fnmatch.translate(entry)).match)
+            else:
+                names.add(entry)
+        return names, patterns
+
+    def _classify(self, table, whitelisting, names, patterns):
+        listed = table in names or any([match(table) for match in patterns])
+        return listed != whitelisting
+
+    def _refresh(self):
+        """Prepares again if the lists hold something else than they did,
+        and returns the state to use."""
+        state = self.state
+        if (state is None or state[0] != frozenset(settings.BLACKLIST)
+                or state[1] != frozenset(settings.WHITELIST)):
+            self.prepare()
+            state = self.state
+        return state
+
+    def disallowed(self, tables):
+        state = self.state
+        # sets compare with the frozensets without copying;  only other
+        # kinds of lists, or changed ones, take the slower way
+        if (state is None or state[0] != settings.BLACKLIST
+                or state[1] != settings.WHITELIST):
+            state = self._refresh()
+        decisions = state[6]
+        decision = decisions.get(tables)
+        if decision is None:
+            whitelisting, names, patterns, classified = state[2:6]
+            decision = False
+            for table in tables:
+                disallowed = classified.get(table)
+                if disallowed is None:
+                    # not the table of a model
+                    disallowed = classified[table] = self._classify(
+                        table, whitelisting, names, patterns)
+                if disallowed:
+                    decision = True
+                    break
+            if len(decisions) >= self.max_decisions:
+                decisions.clear()
+            decisions[tables] = decision
+        return decision
+
+table_filter = TableFilter()
+
+
 def disallowed_table(*tables):
     """Returns True if a set of tables is in the blacklist or, if a whitelist is set,
     any of the tables is not in the whitelist. False otherwise."""
-    # XXX: When using a black or white list, this has to be done EVERY query;
-    # It'd be nice to make this as fast as possible.  In general, queries
-    # should have relatively few tables involved, and I don't imagine that
-    # blacklists would grow very vast.  The fastest i've been able to come
-    # up with is to pre-create a blacklist set and use intersect.
-    return not bool(settings.WHITELIST.issuperset(tables)) if settings.WHITELIST\
-        else bool(settings.BLACKLIST.intersection(tables))
+    return table_filter.disallowed(tables)
 
 
 def get_backend(**kwargs):
@@ -81,6 +301,17 @@ def disable():
 
 patch,unpatch = enable,disable
 
+def batch(*querysets):
+    """
+    Evaluates ``querysets`` as ``list()`` would, but looks up their table
+    generations with a single ``get_many`` and then their cached results
+    with another, rather than going back and forth for each of them in turn.
+    Only the querysets that miss the cache are run against the database.
+    Returns ``querysets``.
+    """
+    get_backend().batch(querysets)
+    return querysets
+
 def prefetch_generations(db='default'):
     backend = get_backend()
     keyhandler = backend.keyhandler
@@ -90,7 +321,7 @@ def prefetch_generations(db='default'):
         key = keyhandler.keygen.gen_table_key(table, db)
         keys.add(key)
     keys = list(keys)
-    keyhandler.cache_backend.get_many(keys)
+    keyhandler.cache_backend.get_many(keys, db)
 
 def resolve_table(x):
     """Return a table name for x, where x is either a model instance or a string."""
@@ -140,6 +371,378 @@ def get_tables_for_query(query):
     return list(set(tables))
 
 
+class QueryTables(object):
+    """
+    Remembers the tables ``get_tables_for_query`` found for the last
+    ``max_entries`` statements, by their sql, so that executing a statement
+    again doesn't walk its query again.  Subqueries are part of the sql, so
+    it names every table that the walk would find.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lru = LRUCache(max_entries, sizeof=lambda value: 1)
+        self.lock = threading.Lock()
+
+    def get(self, query, sql):
+        if not self.max_entries:
+            return get_tables_for_query(query)
+        self.lock.acquire()
+        try:
+            tables = self.lru.get(sql)
+        finally:
+            self.lock.release()
+        if tables is None:
+            tables = tuple(get_tables_for_query(query))
+            self.lock.acquire()
+            try:
+                self.lru[sql] = tables
+            finally:
+                self.lock.release()
+        return list(tables)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.lru.clear()
+        finally:
+            self.lock.release()
+
+query_tables = QueryTables(settings.QUERY_TABLES_CACHE_SIZE)
+
+
+def get_pk_condition(query):
+    """
+    If ``query`` selects whole rows from its model's table alone, with a
+    single condition on the primary key, returns the lookup type and value
+    of that condition.  Otherwise returns None.  This only looks at the
+    query's structure, so it can be done before compiling the query.
+    """
+    opts = query.model._meta
+    where = query.where
+    # filter() nests each call's conditions in a node of their own
+    while (len(where.children) == 1 and not where.negated
+           and not isinstance(where.children[0], tuple)):
+        where = where.children[0]
+    if (len(where.children) != 1 or where.negated or query.having.children
+            or query.distinct or query.extra or query.extra_tables
+            or query.aggregates or not query.default_cols
+            or query.select_related or query.deferred_loading[0]
+            or len(query.tables) != 1):
+        return None
+    child = where.children[0]
+    if not isinstance(child, tuple) or len(child) != 4:
+        return None
+    constraint, lookup_type, annotation, value = child
+    if (constraint.field is not opts.pk
+            or constraint.alias != query.tables[0]):
+        return None
+    return lookup_type, value
+
+
+def get_pk_lookup(query):
+    """
+    If ``query`` is a plain ``get(pk=...)`` of a whole row, returns the
+    primary key, otherwise None.
+    """
+    condition = get_pk_condition(query)
+    if condition is None or query.low_mark:
+        return None
+    lookup_type, value = condition
+    if (lookup_type != 'exact' or value is None
+            or not isinstance(value, (int, long, basestring))):
+        return None
+    return value
+
+
+def get_pk_in_lookup(query):
+    """
+    If ``query`` is a plain ``filter(pk__in=...)`` of whole rows, ordered by
+    nothing but the primary key, returns the primary keys and the ordering:
+    None, 'asc' or 'desc'.  Otherwise returns None.
+    """
+    condition = get_pk_condition(query)
+    if (condition is None or query.low_mark
+            or query.high_mark is not None):
+        return None
+    lookup_type, value = condition
+    if lookup_type != 'in' or not isinstance(value, (list, tuple)):
+        return None
+    opts = query.model._meta
+    ordering = list(query.order_by or query.extra_order_by or
+                    (query.default_ordering and opts.ordering) or [])
+    if not ordering:
+        return value, None
+    if len(ordering) == 1:
+        name = ordering[0]
+        direction = 'asc'
+        if name.startswith('-'):
+            name, direction = name[1:], 'desc'
+        if name in ('pk', opts.pk.name, opts.pk.attname):
+            return value, direction
+    return None
+
+
+def get_prefetch_tables(model, lookups):
+    """
+    Returns the tables that ``prefetch_related(*lookups)`` on instances of
+    ``model`` will select from, as far as the relations of the models tell,
+    along with ``model``'s own, which the queries filter on.
+    """
+    try:
+        from django.db.models.constants import LOOKUP_SEP
+    except ImportError:
+        from django.db.models.sql.constants import LOOKUP_SEP
+    tables = set([model._meta.db_table])
+    for lookup in lookups:
+        current = model
+        for name in lookup.split(LOOKUP_SEP):
+            descriptor = getattr(current, name, None)
+            related = getattr(descriptor, 'related', None)
+            field = getattr(descriptor, 'field', None)
+            if related is not None:
+                field, current = related.field, related.model
+            elif getattr(field, 'rel', None) is not None:
+                current = field.rel.to
+            else:
+                # a generic relation or some other prefetcher
+                break
+            through = getattr(field.rel, 'through', None)
+            if through is not None:
+                tables.add(through._meta.db_table)
+            tables.add(current._meta.db_table)
+    return list(tables)
+
+
+def get_count_type(query, result_type):
+    """
+    Tells how the result of ``query`` relates to the number of rows that
+    match its conditions:  'rows' if it selects those rows, 'count' if it's
+    their ``count()`` and 'exists' if it's their ``exists()``.  Returns None
+    for any other query, including any that groups or removes duplicates.
+    """
+    from django.db.models.sql.aggregates import Count
+    from django.db.models.sql.constants import MULTI, SINGLE
+    if (query.distinct or query.group_by is not None or query.having.children
+            or query.low_mark):
+        return None
+    if result_type == MULTI:
+        if query.high_mark is None and not query.aggregate_select:
+            return 'rows'
+    elif (result_type == SINGLE and not query.select
+            and not query.default_cols):
+        aggregates = query.aggregate_select.values()
+        if not aggregates:
+            if query.extra_select.keys() == ['a'] and query.high_mark == 1:
+                return 'exists'
+        elif (len(aggregates) == 1 and isinstance(aggregates[0], Count)
+                and aggregates[0].col == '*'
+                and not aggregates[0].extra.get('distinct')
+                and not query.extra_select and query.high_mark is None):
+            return 'count'
+    return None
+
+
+def get_query_fingerprint(compiler):
+    """
+    Returns the FROM and WHERE clauses of the query ``compiler`` has just
+    compiled and their parameters, which are what decide the rows it matches
+    regardless of the columns it selects or their order.
+    """
+    if getattr(compiler, 'johnny_uncompiled', False):
+        # answered from the compile cache, which leaves out the joins that
+        # compiling sets up, and they can change the number of rows
+        compiler.as_sql()
+    from_, from_params = compiler.get_from_clause()
+    where, where_params = compiler.query.where.as_sql(
+        qn=compiler.quote_name_unless_alias, connection=compiler.connection)
+    return ('FROM %s WHERE %s' % (' '.join(from_), where or ''),
+            tuple(from_params) + tuple(where_params))
+
+
+# query attributes that don't go into its sql, or that are derived from
+# others;  where and having are described separately
+UNCOMPILED_ATTRS = frozenset(['where', 'having', 'used_aliases',
+    'filter_is_sticky', 'dupe_avoidance', 'join_map', 'table_map',
+    '_aggregate_select_cache', '_extra_select_cache'])
+
+
+_ATOMS = frozenset([type(None), bool, int, long, float, str, unicode])
+_CONTAINERS = frozenset([list, tuple, dict, SortedDict, set, frozenset])
+
+
+def _freeze(value):
+    """
+    Returns a hashable copy of ``value`` for a query signature, or raises
+    TypeError for values that aren't known to be part of a query's shape.
+    Classes and fields are kept as they are;  they live as long as their
+    models.
+    """
+    kind = type(value)
+    if kind in _ATOMS:
+        return value
+    if kind is list or kind is tuple or isinstance(value, tuple):
+        return tuple([v if type(v) in _ATOMS else _freeze(v)
+                      for v in value])
+    if kind is dict:
+        return frozenset([(k, _freeze(v)) for k, v in value.iteritems()])
+    if kind is SortedDict:
+        return tuple([(k, _freeze(v)) for k, v in value.items()])
+    if kind is set or kind is frozenset:
+        return frozenset([_freeze(v) for v in value])
+    if isinstance(value, (type, Field)):
+        return value
+    raise TypeError(kind)
+
+
+def _where_signature(node):
+    if type(node) is not WhereNode:
+        raise TypeError(type(node))
+    children = []
+    for child in node.children:
+        if not isinstance(child, tuple):
+            children.append(_where_signature(child))
+            continue
+        constraint, lookup_type, annotation, value = child
+        if (type(constraint) is not Constraint or hasattr(value, 'as_sql')
+                or hasattr(value, '_as_sql') or hasattr(value, 'query')):
+            raise TypeError(type(value))
+        if lookup_type in ('in', 'range'):
+            value = len(value)
+        else:
+            value = lookup_type == 'exact' and value == ''
+        children.append((constraint.alias, constraint.col, constraint.field,
+                         lookup_type, _freeze(annotation), value))
+    return (node.connector, node.negated, tuple(children))
+
+
+def get_query_signature(compiler):
+    """
+    Returns a hashable signature of everything that goes into the sql of
+    the query ``compiler`` compiles except the values its conditions compare
+    against, or None if the query has parts that the signature can't
+    describe, such as subqueries, expressions, ``extra()`` or aggregates.
+    """
+    from django.db.models.sql.compiler import SQLAggregateCompiler
+    query = compiler.query
+    if isinstance(compiler, SQLAggregateCompiler):
+        return None
+    if (query.extra or query.aggregates or query.having.children
+            or (query.select_related and not query.related_select_cols)):
+        # select_related() has to be set up to read the cached rows
+        return None
+    try:
+        attrs = []
+        for k, v in query.__dict__.iteritems():
+            if k in UNCOMPILED_ATTRS:
+                continue
+            # most attributes are plain values or empty containers
+            kind = type(v)
+            if kind not in _ATOMS:
+                if kind in _CONTAINERS and not v:
+                    v = ()
+                else:
+                    v = _freeze(v)
+            attrs.append((k, v))
+        attrs = frozenset(attrs)
+        where = _where_signature(query.where)
+    except (TypeError, ValueError):
+        return None
+    return (type(compiler), compiler.using, type(query), attrs, where)
+
+
+def get_where_params(node, connection):
+    """
+    Returns the parameters ``node`` compiles to, in order, or None if they
+    depend on more than its conditions' values, in which case it has to be
+    compiled after all.
+    """
+    from django.db.models.base import ObjectDoesNotExist
+    params = []
+    for child in node.children:
+        if isinstance(child, WhereNode):
+            child_params = get_where_params(child, connection)
+            if child_params is None:
+                return None
+            params.extend(child_params)
+            continue
+        constraint, lookup_type, annotation, value = child
+        if lookup_type == 'isnull':
+            continue
+        if lookup_type == 'in' and not annotation:
+            # an empty list can't match anything
+            return None
+        try:
+            child_params = (constraint.field or Field()).get_db_prep_lookup(
+                lookup_type, value, connection=connection, prepared=True)
+        except ObjectDoesNotExist:
+            return None
+        if hasattr(child_params, 'as_sql'):
+            return None
+        if (lookup_type == 'exact' and len(child_params) == 1
+                and child_params[0] == ''
+                and connection.features.interprets_empty_strings_as_nulls):
+            continue
+        params.extend(child_params)
+    return params
+
+
+class CompiledQueries(object):
+    """
+    Remembers the sql, ordering and tables of the last ``max_entries`` query
+    shapes, by their ``get_query_signature``, so that compiling a query of
+    the same shape again only has to collect the values of its conditions.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lru = LRUCache(max_entries, sizeof=lambda value: 1)
+        self.lock = threading.Lock()
+
+    def compile(self, compiler):
+        """
+        Returns the sql and parameters of ``compiler``'s query, as
+        ``compiler.as_sql()`` would, and its ``compiler.get_ordering()`` and
+        tables if the query could be compiled from here, or None for both.
+        Neither can be had from a query that hasn't been compiled, which
+        is how a query answered from here is left.
+        """
+        signature = None
+        if self.max_entries:
+            signature = get_query_signature(compiler)
+        if signature is not None:
+            self.lock.acquire()
+            try:
+                entry = self.lru.get(signature)
+            finally:
+                self.lock.release()
+            if entry is not None:
+                params = get_where_params(compiler.query.where,
+                                          compiler.connection)
+                if params is not None:
+                    sql, ordering, tables = entry
+                    compiler.johnny_uncompiled = True
+                    return sql, tuple(params), ordering, list(tables)
+        sql, params = compiler.as_sql()
+        if not sql or signature is None:
+            return sql, params, None, None
+        ordering = compiler.get_ordering()
+        tables = tuple(get_tables_for_query(compiler.query))
+        self.lock.acquire()
+        try:
+            self.lru[signature] = (sql, ordering, tables)
+        finally:
+            self.lock.release()
+        return sql, params, ordering, list(tables)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.lru.clear()
+        finally:
+            self.lock.release()
+
+compiled_queries = CompiledQueries(settings.COMPILE_CACHE_SIZE)
+
+
 def timer(func):
     times = []
 
@@ -163,6 +766,13 @@ class KeyGen(object):
 
     def __init__(self, prefix):
         self.prefix = prefix
+        self._query_key_re = re.compile(r'%s_.*_query_[0-9a-f]{32}\.[0-9a-f]{32}$'
+                                        % re.escape(str(prefix)))
+
+    def is_query_key(self, key):
+        """Returns True if ``key`` is a query result key built by
+        ``KeyHandler.sql_key`` rather than a table generation key."""
+        return self._query_key_re.match(key) is not None
 
     def random_generator(self):
         """Creates a random unique id."""
@@ -210,36 +820,153 @@ class KeyHandler(object):
         self.prefix = prefix
         self.keygen = keygen(prefix)
         self.cache_backend = cache_backend
+        self._row_columns = {}
+        self._local = threading.local()
 
     def get_generation(self, *tables, **kwargs):
         """Get the generation key for any number of tables."""
+        return self.get_generation_info(*tables, **kwargs)[0]
+
+    def get_generation_info(self, *tables, **kwargs):
+        """
+        Returns the generation key for any number of tables along with
+        whether any of them had no generation and has just been given one,
+        in which case nothing can be cached under the generation key yet.
+        """
         db = kwargs.get('db', 'default')
         if len(tables) > 1:
-            return self.get_multi_generation(tables, db)
-        return self.get_single_generation(tables[0], db)
+            return self._multi_generation_info(tables, db)
+        return self._single_generation_info(tables[0], db)
 
     def get_single_generation(self, table, db='default'):
         """Creates a random generation value for a single table name"""
+        return self._single_generation_info(table, db)[0]
+
+    def _single_generation_info(self, table, db):
         key = self.keygen.gen_table_key(table, db)
+        pinned = getattr(self._local, 'generations', None)
+        if pinned and key in pinned:
+            return pinned[key], False
         val = self.cache_backend.get(key, None, db)
         #if local.get('in_test', None): print str(val).ljust(32), key
         if val == None:
-            val = self.keygen.random_generator()
-            self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
-        return val
+            return self.create_generations([key], db)[key], True
+        return val, False
 
     def get_multi_generation(self, tables, db='default'):
         """Takes a list of table names and returns an aggregate
         value for the generation"""
-        self.cache_backend.get_many([
-            self.keygen.gen_table_key(table, db)
-            for table in tables
-        ])
-        generations = []
-        for table in tables:
-            generations.append(self.get_single_generation(table, db))
+        return self._multi_generation_info(tables, db)[0]
+
+    def _multi_generation_info(self, tables, db):
+        keys = [self.keygen.gen_table_key(table, db) for table in tables]
+        generations, minted = self._table_generations_info(keys, db)
+        return (self.keygen.gen_key(*[generations[key] for key in keys]),
+                minted)
+
+    def speculate(self, tables, key_func, db='default'):
+        """
+        Returns the generation key for ``tables``, whether it's new (as
+        ``get_generation_info`` does), the cache key ``key_func`` makes of it
+        and the value cached under that key, or a ``NotInCache``.  The key
+        made of the generations the tables had when last seen is fetched
+        along with their actual generations, so that if they haven't
+        changed it all takes a single round trip.  Returns None if the
+        generations are pinned.
+        """
+        if getattr(self._local, 'generations', None):
+            return None
+        keys = [self.keygen.gen_table_key(table, db) for table in tables]
+        guess = speculation.guess(keys)
+        if guess is not None:
+            key = key_func(self._combine(guess))
+            fetched = self.cache_backend.get_many(keys + [key], db)
+            if [fetched.get(k) for k in keys] == guess:
+                speculation.record(True)
+                return self._combine(guess), False, key, fetched.get(
+                    key, NotInCache())
+            speculation.record(False)
+        else:
+            fetched = self.cache_backend.get_many(keys, db)
+
+        generations = dict([(k, fetched[k]) for k in keys
+                            if fetched.get(k) is not None])
+        missing = [k for k in keys if k not in generations]
+        if missing:
+            generations.update(self.create_generations(missing, db))
+        speculation.update(generations)
+        generation = self._combine([generations[k] for k in keys])
+        key = key_func(generation)
+        if missing:
+            return generation, True, key, NotInCache()
+        return generation, False, key, self.cache_backend.get(
+            key, NotInCache(), db)
+
+    def _combine(self, generations):
+        """Returns the generation key for a list of table generations."""
+        if len(generations) == 1:
+            return generations[0]
         return self.keygen.gen_key(*generations)
 
+    def get_table_generations(self, keys, db='default'):
+        """Returns the generations of the table ``keys`` with a single
+        ``get_many``, creating the ones that are missing."""
+        return self._table_generations_info(keys, db)[0]
+
+    def _table_generations_info(self, keys, db):
+        pinned = getattr(self._local, 'generations', None) or {}
+        generations = dict([(key, pinned[key]) for key in keys
+                            if key in pinned])
+        keys = [key for key in keys if key not in generations]
+        missing = []
+        if keys:
+            generations.update(self.cache_backend.get_many(keys, db))
+            missing = [key for key in keys if generations.get(key) is None]
+            if missing:
+                generations.update(self.create_generations(missing, db))
+        return generations, bool(missing)
+
+    @contextmanager
+    def pinned_generations(self, tables, db='default'):
+        """
+        Fetches the generations of ``tables`` at once, and uses them rather
+        than looking them up again until the end of the ``with`` block.
+        """
+        keys = [self.keygen.gen_table_key(table, db) for table in tables]
+        with self.pin_generations(self.get_table_generations(keys, db)) \
+                as pinned:
+            yield pinned
+
+    @contextmanager
+    def pin_generations(self, generations):
+        """
+        Uses the ``generations`` of table keys rather than looking them up
+        until the end of the ``with`` block.  Tables invalidated in the
+        meantime get their new generations.
+        """
+        previous = getattr(self._local, 'generations', None)
+        pinned = dict(previous or {})
+        pinned.update(generations)
+        self._local.generations = pinned
+        try:
+            yield pinned
+        finally:
+            self._local.generations = previous
+
+    def create_generations(self, keys, db='default'):
+        """Creates random generations for the table ``keys``, which had
+        none, and returns them.  Where the cache backend can, a generation
+        another process created at the same time is returned instead."""
+        generations = dict((key, self.keygen.random_generator())
+                           for key in keys)
+        get_or_add_many = getattr(self.cache_backend, 'get_or_add_many', None)
+        if get_or_add_many is not None:
+            return get_or_add_many(generations, settings.MIDDLEWARE_SECONDS,
+                                   db)
+        for key, val in generations.iteritems():
+            self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+        return generations
+
     def invalidate_table(self, table, db='default'):
         """Invalidates a table's generation and returns a new one
         (Note that this also invalidates all multi generations
@@ -247,8 +974,27 @@ class KeyHandler(object):
         key = self.keygen.gen_table_key(table, db)
         val = self.keygen.random_generator()
         self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+        if settings.SPECULATIVE_FETCH:
+            speculation.update({key: val})
+        pinned = getattr(self._local, 'generations', None)
+        if pinned and key in pinned:
+            pinned[key] = val
         return val
 
+    def row_key(self, generation, model, pk, using='default'):
+        """
+        Return the cache key for the row of ``model`` with primary key
+        ``pk``, as selected by ``model.objects.get(pk=pk)``.
+        """
+        opts = model._meta
+        columns = self._row_columns.get(opts)
+        if columns is None:
+            columns = self._row_columns[opts] = (
+                opts.db_table, [f.column for f in opts.fields])
+        suffix = self.keygen.gen_key(columns, pk, 'row')
+        using = settings.DB_CACHE_KEYS[using]
+        return '%s_%s_query_%s.%s' % (self.prefix, using, generation, suffix)
+
     def sql_key(self, generation, sql, params, order, result_type,
                 using='default'):
         """
@@ -295,6 +1041,8 @@ class QueryCacheBackend(object):
             self.keyhandler = self.kh_class(self.cache_backend,
                                             self.kg_class, self.prefix)
         self._patched = getattr(self, '_patched', False)
+        if not hasattr(self, '_local'):
+            self._local = threading.local()
 
     def _monkey_select(self, original):
         from django.db.models.sql.constants import MULTI
@@ -309,8 +1057,17 @@ class QueryCacheBackend(object):
 
             if any([isinstance(cls, c) for c in self._write_compilers]):
                 return original(cls, *args, **kwargs)
+            if self.cache_backend.is_bypassed():
+                return original(cls, *args, **kwargs)
+            if settings.OBJECT_CACHE and result_type == MULTI:
+                pk = get_pk_lookup(cls.query)
+                if pk is not None:
+                    table = cls.query.model._meta.db_table
+                    if not disallowed_table(table):
+                        return self._select_object(cls, original, pk, table)
             try:
-                sql, params = cls.as_sql()
+                sql, params, ordering, tables = \
+                    compiled_queries.compile(cls)
                 if not sql:
                     raise EmptyResultSet
             except EmptyResultSet:
@@ -322,21 +1079,68 @@ class QueryCacheBackend(object):
 
             db = getattr(cls, 'using', 'default')
             key, val = None, NotInCache()
+            count_type = count_key = None
             # check the blacklist for any of the involved tables;  if it's not
             # there, then look for the value in the cache.
-            tables = get_tables_for_query(cls.query)
+            if tables is None:
+                tables = query_tables.get(cls.query, sql)
             # if the tables are blacklisted, send a qc_skip signal
             blacklisted = disallowed_table(*tables)
             if blacklisted:
                 signals.qc_skip.send(sender=cls, tables=tables,
                     query=(sql, params, cls.query.ordering_aliases),
                     key=key)
+            if (settings.ROW_CACHE and len(tables) == 1 and not blacklisted
+                    and result_type == MULTI):
+                lookup = get_pk_in_lookup(cls.query)
+                if lookup is not None:
+                    return self._select_rows(cls, original, lookup, tables[0],
+                        db, (sql, params, cls.query.ordering_aliases))
             if tables and not blacklisted:
-                gen_key = self.keyhandler.get_generation(*tables, **{'db': db})
-                key = self.keyhandler.sql_key(gen_key, sql, params,
-                                              cls.get_ordering(),
-                                              result_type, db)
-                val = self.cache_backend.get(key, NotInCache(), db)
+                if ordering is None:
+                    ordering = cls.get_ordering()
+                speculated = None
+                if settings.SPECULATIVE_FETCH:
+                    speculated = self.keyhandler.speculate(tables,
+                        lambda generation: self.keyhandler.sql_key(
+                            generation, sql, params, ordering, result_type,
+                            db), db)
+                if speculated is not None:
+                    gen_key, minted, key, val = speculated
+                else:
+                    gen_key, minted = self.keyhandler.get_generation_info(
+                        *tables, **{'db': db})
+                    key = self.keyhandler.sql_key(gen_key, sql, params,
+                                                  ordering, result_type, db)
+                    preloaded = getattr(self._local, 'results', None)
+                    if preloaded and key in preloaded:
+                        val = preloaded.pop(key)
+                    elif not minted:
+                        # nothing can be cached under a brand new generation
+                        val = self.cache_backend.get(key, NotInCache(), db)
+                if (isinstance(val, NotInCache) and settings.SLICE_CACHE
+                        and result_type == MULTI
+                        and (cls.query.low_mark or
+                             cls.query.high_mark is not None)):
+                    return self._select_slice(cls, original, gen_key, minted,
+                        key, tables, db,
+                        (sql, params, cls.query.ordering_aliases))
+                if settings.COUNT_CACHE:
+                    count_type = get_count_type(cls.query, result_type)
+                if count_type is not None:
+                    fingerprint, fingerprint_params = \
+                        get_query_fingerprint(cls)
+                    count_key = self.keyhandler.sql_key(gen_key, fingerprint,
+                        fingerprint_params, (), 'count', db)
+                if (count_type in ('count', 'exists') and not minted
+                        and isinstance(val, NotInCache)):
+                    # answer count() and exists() from the number of rows
+                    # cached for a query with the same conditions
+                    count = self.cache_backend.get(count_key, None, db)
+                    if count is not None and count_type == 'count':
+                        val = (count,)
+                    elif count is not None:
+                        val = count and (1,) or no_result_sentinel
 
             if not isinstance(val, NotInCache):
                 if val == no_result_sentinel:
@@ -352,22 +1156,287 @@ class QueryCacheBackend(object):
                     query=(sql, params, cls.query.ordering_aliases),
                     key=key)
 
-            val = original(cls, *args, **kwargs)
-
-            if hasattr(val, '__iter__'):
-                #Can't permanently cache lazy iterables without creating
-                #a cacheable data structure. Note that this makes them
-                #no longer lazy...
-                #todo - create a smart iterable wrapper
-                val = list(val)
-            if key is not None:
-                if not val:
-                    self.cache_backend.set(key, no_result_sentinel, settings.MIDDLEWARE_SECONDS, db)
-                else:
-                    self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
-            return val
+            def execute():
+                val = original(cls, *args, **kwargs)
+
+                if hasattr(val, '__iter__'):
+                    #Can't permanently cache lazy iterables without creating
+                    #a cacheable data structure. Note that this makes them
+                    #no longer lazy...
+                    #todo - create a smart iterable wrapper
+                    val = list(val)
+                if key is not None:
+                    if not val:
+                        self.cache_backend.set(key, no_result_sentinel, settings.MIDDLEWARE_SECONDS, db)
+                    else:
+                        self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+                if count_type == 'rows':
+                    self.cache_backend.set(count_key,
+                        sum([len(chunk) for chunk in val]),
+                        settings.MIDDLEWARE_SECONDS, db)
+                return val
+
+            if key is not None and settings.SINGLE_FLIGHT:
+                return single_flight.do(key, execute)
+            return execute()
         return newfun
 
+    def batch(self, querysets):
+        """
+        Evaluates the ``querysets`` that haven't been yet, looking up all
+        their generations and then all their cached results at once.
+        """
+        from django.db.models.sql.constants import MULTI
+        from django.db.models.sql.datastructures import EmptyResultSet
+        pending = [qs for qs in querysets if qs._result_cache is None]
+        if not self._patched or self.cache_backend.is_bypassed():
+            for qs in pending:
+                len(qs)
+            return
+
+        queries = []
+        table_keys = {}
+        for qs in pending:
+            compiler = qs.query.get_compiler(qs.db)
+            try:
+                sql, params, ordering, tables = \
+                    compiled_queries.compile(compiler)
+            except EmptyResultSet:
+                continue
+            if tables is None:
+                tables = query_tables.get(qs.query, sql)
+            if sql and tables and not disallowed_table(*tables):
+                if ordering is None:
+                    ordering = compiler.get_ordering()
+                queries.append((compiler, sql, params, ordering, tables))
+                table_keys.setdefault(qs.db, set()).update(
+                    [self.keyhandler.keygen.gen_table_key(table, qs.db)
+                     for table in tables])
+        generations = {}
+        for db, keys in table_keys.iteritems():
+            generations.update(
+                self.keyhandler.get_table_generations(list(keys), db))
+
+        with self.keyhandler.pin_generations(generations):
+            keys = {}
+            for compiler, sql, params, ordering, tables in queries:
+                db = compiler.using
+                generation = self.keyhandler.get_generation(*tables,
+                                                            **{'db': db})
+                keys.setdefault(db, []).append(self.keyhandler.sql_key(
+                    generation, sql, params, ordering, MULTI, db))
+            previous = getattr(self._local, 'results', None)
+            results = dict(previous or {})
+            for db, db_keys in keys.iteritems():
+                cached = self.cache_backend.get_many(db_keys, db)
+                for key in db_keys:
+                    # known misses skip the lookup too
+                    results[key] = cached.get(key, NotInCache())
+            self._local.results = results
+            try:
+                for qs in pending:
+                    len(qs)
+            finally:
+                self._local.results = previous
+
+    def _monkey_prefetch(self, original):
+        @wraps(original, assigned=available_attrs(original))
+        def newfun(result_cache, related_lookups):
+            if not settings.BATCH_PREFETCH or not result_cache:
+                return original(result_cache, related_lookups)
+            instance = result_cache[0]
+            tables = get_prefetch_tables(type(instance), related_lookups)
+            tables = [table for table in tables if not disallowed_table(table)]
+            if not tables or self.cache_backend.is_bypassed():
+                return original(result_cache, related_lookups)
+            # the queries of each level depend on the results of the last,
+            # so only their generations can be fetched ahead of time
+            with self.keyhandler.pinned_generations(tables,
+                                                    instance._state.db):
+                return original(result_cache, related_lookups)
+        return newfun
+
+    def _select_slice(self, cls, original, generation, minted, key, tables,
+                      db, query):
+        """
+        Answers a sliced query from the cached result of the same query
+        without the slice.  If that isn't cached and it has no more than
+        ``SLICE_CACHE_ROWS`` rows, it's selected and cached instead of the
+        slice, so that the other slices can be answered from it too.
+        """
+        from django.db.models.sql.constants import MULTI
+        low, high = cls.query.low_mark, cls.query.high_mark
+        full_query = cls.query.clone()
+        full_query.clear_limits()
+        compiler = full_query.get_compiler(cls.using)
+        sql, params = compiler.as_sql()
+        full_key = self.keyhandler.sql_key(generation, sql, params,
+                                           compiler.get_ordering(), MULTI, db)
+        val = NotInCache()
+        if not minted:
+            val = self.cache_backend.get(full_key, val, db)
+        if not isinstance(val, NotInCache):
+            rows = []
+            if val != no_result_sentinel:
+                for chunk in val:
+                    rows.extend(chunk)
+            rows = rows[low:high]
+            signals.qc_hit.send(sender=cls, tables=tables, query=query,
+                                size=len(rows), key=full_key)
+            return rows and [rows] or []
+
+        signals.qc_miss.send(sender=cls, tables=tables, query=query, key=key)
+        limit = settings.SLICE_CACHE_ROWS
+        if limit:
+            full_query.set_limits(0, limit + 1)
+            rows = []
+            for chunk in original(full_query.get_compiler(cls.using), MULTI):
+                rows.extend(chunk)
+            if len(rows) <= limit:
+                self.cache_backend.set(full_key, rows and [rows] or
+                                       no_result_sentinel,
+                                       settings.MIDDLEWARE_SECONDS, db)
+                rows = rows[low:high]
+                return rows and [rows] or []
+            if high is not None and high <= len(rows):
+                val = [rows[low:high]]
+                self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS,
+                                       db)
+                return val
+        val = list(original(cls, MULTI))
+        self.cache_backend.set(key, val or no_result_sentinel,
+                               settings.MIDDLEWARE_SECONDS, db)
+        return val
+
+    def _signal_query(self, signal, compiler):
+        """
+        Returns the ``query`` that ``signal`` is sent with for ``compiler``,
+        which has not been compiled.  A copy of it is only compiled if the
+        signal has receivers, since the point is to not compile it at all.
+        """
+        if not signal.receivers:
+            return None
+        compiler = compiler.query.clone().get_compiler(compiler.using)
+        sql, params = compiler.as_sql()
+        return sql, params, compiler.query.ordering_aliases
+
+    def _select_object(self, cls, original, pk, table):
+        """
+        Answers a ``get(pk=...)`` query from the row cached for ``pk``
+        without compiling the query, or else selects and caches the row.
+        """
+        db = getattr(cls, 'using', 'default')
+        generation, minted = self.keyhandler.get_generation_info(table, db=db)
+        key = self.keyhandler.row_key(generation, cls.query.model, pk, db)
+        row = None
+        if not minted:
+            row = self.cache_backend.get(key, None, db)
+        if row is not None:
+            signals.qc_hit.send(sender=cls, tables=[table],
+                                query=self._signal_query(signals.qc_hit, cls),
+                                size=int(row != no_result_sentinel), key=key)
+            if row == no_result_sentinel:
+                return []
+            return [[row]]
+
+        signals.qc_miss.send(sender=cls, tables=[table],
+                             query=self._signal_query(signals.qc_miss, cls),
+                             key=key)
+        rows = []
+        for chunk in original(cls):
+            rows.extend(chunk)
+        if len(rows) > 1:
+            # can't happen for a primary key, but don't cache it if it does
+            return [rows]
+        if rows:
+            self.cache_backend.set(key, rows[0], settings.MIDDLEWARE_SECONDS,
+                                   db)
+            return [rows]
+        self.cache_backend.set(key, no_result_sentinel,
+                               settings.MIDDLEWARE_SECONDS, db)
+        return []
+
+    def _select_rows(self, cls, original, lookup, table, db, query):
+        """
+        Answers a ``filter(pk__in=...)`` query from rows cached one by one,
+        selecting only the rows that aren't cached from the database.  If
+        it returns a row under a primary key that wasn't asked for, the
+        query is run as it is instead, and nothing is cached.
+        """
+        from django.db.models.sql.constants import MULTI
+        ids, ordering = lookup
+        model = cls.query.model
+        pk_index = model._meta.fields.index(model._meta.pk)
+        generation, minted = self.keyhandler.get_generation_info(table, db=db)
+        keys = {}
+        for pk in ids:
+            keys[pk] = self.keyhandler.row_key(generation, model, pk, db)
+        cached = {}
+        if not minted:
+            cached = self.cache_backend.get_many(keys.values(), db)
+        rows = {}
+        missing = []
+        for pk in ids:
+            key = keys[pk]
+            if key in cached:
+                if cached[key] != no_result_sentinel:
+                    rows[pk] = cached[key]
+            elif pk not in missing:
+                missing.append(pk)
+
+        if missing:
+            signals.qc_miss.send(sender=cls, tables=[table], query=query,
+                                 key=None)
+            pk_field = model._meta.pk
+            def normalize(pk):
+                return pk_field.get_prep_value(pk_field.to_python(pk))
+            wanted = dict([(normalize(pk), pk) for pk in missing])
+            found = {}
+            for row in self._select_missing(cls, original, missing):
+                pk = normalize(row[pk_index])
+                if pk not in wanted:
+                    # the database matched a primary key written another
+                    # way, with a case-insensitive collation for instance,
+                    # so the rows can't be told apart by the keys asked for
+                    return list(original(cls, MULTI))
+                found[wanted[pk]] = row
+            rows.update(found)
+            self.cache_backend.set_many(
+                dict([(keys[pk], found.get(pk, no_result_sentinel))
+                      for pk in missing]),
+                settings.MIDDLEWARE_SECONDS, db)
+        else:
+            signals.qc_hit.send(sender=cls, tables=[table], query=query,
+                                size=len(rows), key=None)
+
+        if ordering is None:
+            result, seen = [], set()
+            for pk in ids:
+                if pk in rows and pk not in seen:
+                    seen.add(pk)
+                    result.append(rows[pk])
+        else:
+            result = [rows[pk] for pk in sorted(rows,
+                                                reverse=ordering == 'desc')]
+        if not result:
+            return []
+        return [result]
+
+    def _select_missing(self, cls, original, pks):
+        """Selects the rows of ``cls``'s ``filter(pk__in=...)`` query for
+        the primary keys ``pks`` only, and returns them in a list."""
+        from django.db.models.sql.constants import MULTI
+        query = cls.query.clone()
+        where = query.where
+        while not isinstance(where.children[0], tuple):
+            where = where.children[0]
+        constraint, lookup_type, annotation, value = where.children[0]
+        where.children[0] = (constraint, lookup_type, annotation, pks)
+        rows = []
+        for chunk in original(query.get_compiler(cls.using), MULTI):
+            rows.extend(chunk)
+        return rows
+
     def _monkey_write(self, original):
         @wraps(original, assigned=available_attrs(original))
         def newfun(cls, *args, **kwargs):
@@ -416,16 +1485,29 @@ class QueryCacheBackend(object):
             for updater in self._write_compilers:
                 self._original[updater] = updater.execute_sql
                 updater.execute_sql = self._monkey_write(updater.execute_sql)
+            self._patch_prefetch()
+            table_filter.prepare()
             self._patched = True
             self.cache_backend.patch()
             self._handle_signals()
 
+    def _patch_prefetch(self):
+        from django.db.models import query
+        original = getattr(query, 'prefetch_related_objects', None)
+        if original is not None:
+            self._original['prefetch_related_objects'] = original
+            query.prefetch_related_objects = self._monkey_prefetch(original)
+
     def unpatch(self):
         """un-applies this patch."""
         if not self._patched:
             return
         for func in self._read_compilers + self._write_compilers:
             func.execute_sql = self._original[func]
+        if 'prefetch_related_objects' in self._original:
+            from django.db.models import query
+            query.prefetch_related_objects = \
+                self._original['prefetch_related_objects']
         self.cache_backend.unpatch()
         self._patched = False
 
@@ -438,6 +1520,7 @@ class QueryCacheBackend(object):
     def invalidate(self, instance, **kwargs):
         if self._patched:
             table = resolve_table(instance)
+            # the rows cached for get(pk=...) hang off the generation too
             if not disallowed_table(table):
                 self.keyhandler.invalidate_table(table)
 
@@ -0,0 +1,149 @@
+"""Data structures used by johnny's in-process caches."""
+
+import sys
+
+try:
+    getsizeof = sys.getsizeof
+except AttributeError:
+    # python 2.5
+    def getsizeof(value):
+        return 64
+
+
+def approximate_size(value, sample=8):
+    """
+    Returns an approximation of the memory used by ``value`` in bytes.
+    Lists, tuples and dicts are measured recursively, but only the first
+    ``sample`` items of each are looked at and the rest are assumed to be
+    of a similar size, so that this stays cheap for large query results.
+    """
+    size = getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        items = value[:sample]
+    elif isinstance(value, dict):
+        items = value.items()[:sample]
+    else:
+        return size
+    if items:
+        items_size = 0
+        for item in items:
+            items_size += approximate_size(item, sample)
+        size += items_size * len(value) // len(items)
+    return size
+
+
+# indexes into the links of LRUCache's linked list
+PREV, NEXT, KEY, VALUE, SIZE = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """
+    A dict-like store bounded by the approximate size of its values.  Once
+    the total size goes over ``max_size`` bytes the least recently used
+    items are evicted;  a ``max_size`` of 0 means it's never bounded.  The
+    current total is available as ``size``.  Without a bound, values are
+    only measured when ``size`` is asked for.
+
+    This is not thread-safe;  callers that share an LRUCache between
+    threads have to do their own locking.
+    """
+    def __init__(self, max_size=0, sizeof=approximate_size):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        # the total size of the values measured so far
+        self._size = 0
+        self.evictions = 0
+        self.map = {}
+        # a circular doubly linked list, least recently used first
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __iter__(self):
+        return iter(self.map)
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        root = self.root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+
+    def get(self, key, default=None):
+        link = self.map.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[VALUE]
+
+    def __getitem__(self, key):
+        link = self.map[key]
+        self._unlink(link)
+        self._append(link)
+        return link[VALUE]
+
+    @property
+    def size(self):
+        for link in self.map.itervalues():
+            if link[SIZE] is None:
+                link[SIZE] = self.sizeof(link[VALUE])
+                self._size += link[SIZE]
+        return self._size
+
+    def __setitem__(self, key, value):
+        self.pop(key, None)
+        if not self.max_size:
+            link = [None, None, key, value, None]
+            self._append(link)
+            self.map[key] = link
+            return
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        link = [None, None, key, value, size]
+        self._append(link)
+        self.map[key] = link
+        self._size += size
+        self._evict()
+
+    def _evict(self):
+        root = self.root
+        while self._size > self.max_size and self.map:
+            link = root[NEXT]
+            self._unlink(link)
+            del self.map[link[KEY]]
+            self._size -= link[SIZE]
+            self.evictions += 1
+
+    def pop(self, key, *default):
+        link = self.map.pop(key, None)
+        if link is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._unlink(link)
+        if link[SIZE] is not None:
+            self._size -= link[SIZE]
+        return link[VALUE]
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def update(self, items):
+        for key, value in items.iteritems():
+            self[key] = value
+
+    def clear(self):
+        self.map.clear()
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self._size = 0
@@ -46,11 +46,11 @@ class LocalStoreClearMiddleware(object):
     """
     def process_exception(self, *args, **kwargs):
         cache.local.clear()
-        cache.get_backend().cache_backend.rollback()
+        cache.get_backend().cache_backend.clear()
 
     def process_response(self, req, resp):
         cache.local.clear()
-        cache.get_backend().cache_backend.rollback()
+        cache.get_backend().cache_backend.clear()
         return resp
 
 
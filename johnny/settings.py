@@ -24,8 +24,49 @@ CACHE_BACKEND = getattr(settings, 'JOHNNY_CACHE_BACKEND',
 
 CACHES = getattr(settings, 'CACHES', {})
 
+RESULT_CACHE = getattr(settings, 'JOHNNY_RESULT_CACHE', None)
+
 PREFETCH_GENERATIONS = getattr(settings, 'JOHNNY_PREFETCH_GENERATIONS', True)
 
+SINGLE_FLIGHT = getattr(settings, 'JOHNNY_SINGLE_FLIGHT', False)
+
+LOCAL_CACHE_SIZE = getattr(settings, 'JOHNNY_LOCAL_CACHE_SIZE', 0)
+
+PROCESS_CACHE_SIZE = getattr(settings, 'JOHNNY_PROCESS_CACHE_SIZE', 0)
+
+QUERY_TABLES_CACHE_SIZE = getattr(settings, 'JOHNNY_QUERY_TABLES_CACHE_SIZE',
+                                  1000)
+
+BATCH_PREFETCH = getattr(settings, 'JOHNNY_BATCH_PREFETCH', False)
+
+CIRCUIT_BREAKER = getattr(settings, 'JOHNNY_CIRCUIT_BREAKER', None)
+
+COMPILE_CACHE_SIZE = getattr(settings, 'JOHNNY_COMPILE_CACHE_SIZE', 0)
+
+COUNT_CACHE = getattr(settings, 'JOHNNY_COUNT_CACHE', False)
+
+GENERATION_REPLICAS = getattr(settings, 'JOHNNY_GENERATION_REPLICAS', {})
+
+OBJECT_CACHE = getattr(settings, 'JOHNNY_OBJECT_CACHE', False)
+
+ROW_CACHE = getattr(settings, 'JOHNNY_ROW_CACHE', False)
+
+SLICE_CACHE = getattr(settings, 'JOHNNY_SLICE_CACHE', False)
+SLICE_CACHE_ROWS = getattr(settings, 'JOHNNY_SLICE_CACHE_ROWS', 0)
+
+SPECULATIVE_FETCH = getattr(settings, 'JOHNNY_SPECULATIVE_FETCH', False)
+
+SHARED_CACHE_PATH = getattr(settings, 'JOHNNY_SHARED_CACHE_PATH', None)
+SHARED_CACHE_SIZE = getattr(settings, 'JOHNNY_SHARED_CACHE_SIZE',
+                            64 * 1024 * 1024)
+SHARED_CACHE_SLOT_SIZE = getattr(settings, 'JOHNNY_SHARED_CACHE_SLOT_SIZE', 8192)
+
+SHARED_GENERATION_PATH = getattr(settings, 'JOHNNY_SHARED_GENERATION_PATH', None)
+SHARED_GENERATION_SIZE = getattr(settings, 'JOHNNY_SHARED_GENERATION_SIZE',
+                                 1024 * 1024)
+SHARED_GENERATION_INTERVAL = getattr(settings,
+                                     'JOHNNY_SHARED_GENERATION_INTERVAL', 1.0)
+
 
 def _get_backend():
     """
@@ -51,3 +92,14 @@ def _get_backend():
                 signals.request_finished.connect(backend.close)
         return backend
     return cache
+
+
+def _get_result_backend():
+    """
+    Returns the django cache object johnny keeps query results in when
+    ``JOHNNY_RESULT_CACHE`` names one of the ``CACHES``, or None if results
+    are kept in the same cache as the table generations.
+    """
+    if RESULT_CACHE:
+        return get_cache(RESULT_CACHE)
+    return None
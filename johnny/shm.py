@@ -0,0 +1,233 @@
+"""
+A fixed-size hash table in a memory-mapped file, which every process on a
+host can map to share cached values without going over the network.
+
+The file is split into equal slots, grouped into buckets of ``ways`` slots.
+A key can be stored in any slot of the bucket its hash falls in;  when they
+are all in use the least recently written one is replaced.
+
+Readers never lock.  Each slot starts with a sequence number which a writer
+makes odd before changing the slot and even again afterwards (a seqlock), so
+a reader that sees an odd or changed sequence number knows it raced with a
+writer and treats the slot as a miss.  Writers lock the bucket's byte range
+with ``fcntl.lockf`` so that two processes can't write the same bucket at
+once, and by default skip the write rather than wait if it's already locked.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+MAGIC = 'johnnyc1'
+# magic, slot size, number of slots, ways
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+# counters kept in the header for the users of a table
+VERSION = struct.Struct('<Q')
+VERSION_OFFSET = 32
+WRITES_OFFSET = 40
+# sequence, write time, value length, unused, key digest
+SLOT_HEADER = struct.Struct('<QdII16s')
+SEQ = struct.Struct('<Q')
+EMPTY_DIGEST = '\0' * 16
+
+
+def key_digest(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return md5(key).digest()
+
+
+def open_private(path):
+    """
+    Opens the file at ``path`` for reading and writing, creating it if it
+    doesn't exist yet so that only this user can use it, and returns its
+    descriptor.  Raises OSError if ``path`` is a symbolic link, or if the
+    file is owned by another user or other users can use it:  what is read
+    from it is unpickled.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0),
+                 0600)
+    try:
+        st = os.fstat(fd)
+        if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid()
+                or st.st_mode & 077):
+            raise OSError(errno.EPERM, 'not a file private to this user',
+                          path)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+class SharedTable(object):
+    """
+    A hash table of byte strings in the memory-mapped file at ``path``,
+    which is created with room for ``size`` bytes of slots if it doesn't
+    exist yet.  If it does, the layout it was created with is used.  Values
+    longer than a slot are not stored.  The file must belong to this user
+    and no other (see ``open_private``).
+    """
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=8192, ways=4):
+        self.path = path
+        self.fd = open_private(path)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(self.fd, HEADER.size)
+            if len(header) == HEADER.size and header.startswith(MAGIC):
+                magic, slot_size, slots, ways = HEADER.unpack(header)
+            else:
+                slots = max(size // slot_size // ways, 1) * ways
+                os.ftruncate(self.fd, HEADER_SIZE + slots * slot_size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, slot_size, slots, ways))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.slot_size = slot_size
+        self.slots = slots
+        self.ways = ways
+        self.buckets = slots // ways
+        self.max_value_size = slot_size - SLOT_HEADER.size
+        self.map = mmap.mmap(self.fd, HEADER_SIZE + slots * slot_size,
+                             mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE)
+        # fcntl locks are held per process, so the threads of this process
+        # also have to take turns writing.
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    @property
+    def version(self):
+        return VERSION.unpack_from(self.map, VERSION_OFFSET)[0]
+
+    @property
+    def writes(self):
+        return VERSION.unpack_from(self.map, WRITES_OFFSET)[0]
+
+    def _increment(self, offset):
+        self.lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                value = VERSION.unpack_from(self.map, offset)[0] + 1
+                VERSION.pack_into(self.map, offset, value)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        finally:
+            self.lock.release()
+        return value
+
+    def bump_version(self):
+        """Increments ``version`` and returns the new value."""
+        return self._increment(VERSION_OFFSET)
+
+    def count_write(self):
+        """Increments ``writes`` and returns the new value."""
+        return self._increment(WRITES_OFFSET)
+
+    def _offsets(self, digest):
+        bucket = struct.unpack_from('<Q', digest)[0] % self.buckets
+        first = HEADER_SIZE + bucket * self.ways * self.slot_size
+        return range(first, first + self.ways * self.slot_size,
+                     self.slot_size)
+
+    def _read(self, offset, digest):
+        """Returns the value in the slot at ``offset`` if it holds
+        ``digest`` and wasn't being written, otherwise None."""
+        seq, stamp, length, unused, slot_digest = \
+            SLOT_HEADER.unpack_from(self.map, offset)
+        if seq % 2 or slot_digest != digest or not length:
+            return None
+        start = offset + SLOT_HEADER.size
+        value = self.map[start:start + length]
+        if SEQ.unpack_from(self.map, offset)[0] != seq:
+            return None
+        return value
+
+    def get(self, key):
+        """Returns the value stored for ``key``, or None."""
+        digest = key_digest(key)
+        for offset in self._offsets(digest):
+            value = self._read(offset, digest)
+            if value is not None:
+                return value
+        return None
+
+    def _choose(self, digest):
+        """Picks the slot to write ``digest`` to:  the one already holding
+        it, or else an empty one, or else the least recently written."""
+        chosen, oldest = None, None
+        for offset in self._offsets(digest):
+            seq, stamp, length, unused, slot_digest = \
+                SLOT_HEADER.unpack_from(self.map, offset)
+            if slot_digest == digest:
+                return offset
+            if slot_digest == EMPTY_DIGEST:
+                stamp = -1
+            if oldest is None or stamp < oldest:
+                chosen, oldest = offset, stamp
+        return chosen
+
+    def _write_slot(self, offset, digest, value):
+        seq = SEQ.unpack_from(self.map, offset)[0]
+        if seq % 2:
+            # a writer died half way through;  start over
+            seq += 1
+        SEQ.pack_into(self.map, offset, seq + 1)
+        start = offset + SLOT_HEADER.size
+        self.map[start:start + len(value)] = value
+        SLOT_HEADER.pack_into(self.map, offset, seq + 1, time.time(),
+                              len(value), 0, digest)
+        SEQ.pack_into(self.map, offset, seq + 2)
+
+    def _write(self, digest, value, block=False):
+        """Writes ``value`` for ``digest`` with its bucket locked, or
+        removes it if ``value`` is None.  Returns False if the bucket was
+        locked by another process and ``block`` is false."""
+        first = self._offsets(digest)[0]
+        length = self.ways * self.slot_size
+        flags = fcntl.LOCK_EX
+        if not block:
+            flags |= fcntl.LOCK_NB
+        self.lock.acquire()
+        try:
+            try:
+                fcntl.lockf(self.fd, flags, length, first)
+            except IOError:
+                return False
+            try:
+                offset = self._choose(digest)
+                if value is not None:
+                    self._write_slot(offset, digest, value)
+                elif SLOT_HEADER.unpack_from(self.map, offset)[4] == digest:
+                    self._write_slot(offset, EMPTY_DIGEST, '')
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, first)
+        finally:
+            self.lock.release()
+        return True
+
+    def set(self, key, value, block=False):
+        """Stores the byte string ``value`` for ``key``.  Returns False if
+        it wasn't stored, because it's too big or the bucket was busy;
+        with ``block`` it waits for a busy bucket instead."""
+        if len(value) > self.max_value_size:
+            return False
+        return self._write(key_digest(key), value, block)
+
+    def delete(self, key):
+        self._write(key_digest(key), None, True)
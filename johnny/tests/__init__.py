@@ -12,8 +12,11 @@ http://code.djangoproject.com/ticket/7835#comment:21
 
 # import the other tests from johnny
 from localstore import LocalStoreTest
+from datastructures import LRUCacheTest
 from cache import *
 from web import *
+from tiers import *
+from backends import *
 
 from testapp.models import *
 
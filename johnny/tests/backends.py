@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for johnny's cache backends."""
+
+from django.test import TestCase
+
+from johnny.backends.redis_native import INCR_SCRIPT, RedisCache
+from johnny.cache import KeyGen, KeyHandler
+
+# put tests in here to be included in the testing suite
+__all__ = ['RedisCacheTest']
+
+
+class FakeRedis(object):
+    """Enough of ``redis.StrictRedis`` to run RedisCache without a server.
+    Expiry times are recorded but never acted on."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.round_trips = 0
+
+    def _call(self, name, *args, **kwargs):
+        self.round_trips += 1
+        return getattr(self, '_' + name)(*args, **kwargs)
+
+    def _get(self, name):
+        return self.data.get(name)
+
+    def _mget(self, names):
+        return [self.data.get(name) for name in names]
+
+    def _set(self, name, value, ex=None, nx=False):
+        if nx and name in self.data:
+            return None
+        self.data[name] = str(value)
+        self.expiry[name] = ex
+        return True
+
+    def _delete(self, *names):
+        deleted = 0
+        for name in names:
+            if self.data.pop(name, None) is not None:
+                deleted += 1
+        return deleted
+
+    def _exists(self, name):
+        return name in self.data
+
+    def _incrby(self, name, amount=1):
+        value = int(self.data.get(name, 0)) + amount
+        self.data[name] = str(value)
+        return value
+
+    def _eval(self, script, numkeys, *keys_and_args):
+        # only the scripts RedisCache runs
+        assert script == INCR_SCRIPT
+        name, amount = keys_and_args
+        if name in self.data:
+            return self._incrby(name, amount)
+
+    def _flushdb(self):
+        self.data.clear()
+
+    def __getattr__(self, name):
+        if not hasattr(self.__class__, '_' + name):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, '_' + name)
+        return lambda *args, **kwargs: self.commands.append(
+            (method, args, kwargs))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [method(*args, **kwargs)
+                for method, args, kwargs in self.commands]
+
+
+class RedisCacheTest(TestCase):
+    def setUp(self):
+        self.cache = RedisCache('localhost:6379', {})
+        self.cache._client = self.redis = FakeRedis()
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('a', 'default'), 'default')
+        self.cache.set('a', [1, u'b'])
+        self.assertEqual(self.cache.get('a'), [1, u'b'])
+        self.failUnless(self.cache.has_key('a'))
+        self.failIf(self.cache.add('a', 'other'))
+        self.failUnless(self.cache.add('b', 'other'))
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_timeouts(self):
+        self.cache.set('a', 1, 10)
+        self.cache.set('b', 1, 0)
+        self.cache.set('c', 1)
+        self.assertEqual(self.redis.expiry[self.cache.make_key('a')], 10)
+        self.assertIsNone(self.redis.expiry[self.cache.make_key('b')])
+        self.assertEqual(self.redis.expiry[self.cache.make_key('c')], 300)
+
+    def test_incr(self):
+        self.assertRaises(ValueError, self.cache.incr, 'a')
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.incr('a'), 2)
+        self.assertEqual(self.cache.decr('a', 2), 0)
+        self.assertEqual(self.cache.get('a'), 0)
+
+    def test_incr_is_one_round_trip(self):
+        self.cache.set('a', 1, 60)
+        self.redis.round_trips = 0
+        self.assertEqual(self.cache.incr('a', 5), 6)
+        self.assertEqual(self.redis.round_trips, 1)
+        self.redis.round_trips = 0
+        self.assertRaises(ValueError, self.cache.incr, 'b')
+        self.assertEqual(self.redis.round_trips, 1)
+        # a missing key isn't created without its expiry
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_many_in_one_round_trip(self):
+        self.cache.set_many({'a': 1, 'b': 'two', 'c': None})
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c', 'd']),
+                         {'a': 1, 'b': 'two', 'c': None})
+        self.assertEqual(self.redis.round_trips, 2)
+        self.cache.delete_many(['a', 'b'])
+        self.assertEqual(self.redis.round_trips, 3)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'c': None})
+
+    def test_get_or_add_many(self):
+        self.cache.set('a', 'existing')
+        self.redis.round_trips = 0
+        self.assertEqual(self.cache.get_or_add_many({'a': 'new', 'b': 'new'}),
+                         {'a': 'existing', 'b': 'new'})
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(self.cache.get('b'), 'new')
+
+    def test_concurrent_generations_agree(self):
+        from johnny.transaction import TransactionManager
+        handlers = [KeyHandler(TransactionManager(self.cache, KeyGen),
+                               KeyGen, 'jc') for i in range(2)]
+        key = handlers[0].keygen.gen_table_key('table')
+        # both handlers found no generation and create one at once
+        generations = [h.create_generations([key])[key] for h in handlers]
+        self.assertEqual(generations[0], generations[1])
+        self.assertEqual(handlers[1].get_generation('table'), generations[0])
+
+    def test_commit_is_pipelined(self):
+        from johnny.transaction import TransactionCache
+        tx_cache = TransactionCache(self.cache)
+        tx_cache.set_many(dict(('key%d' % i, i) for i in range(20)))
+        tx_cache.commit()
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(self.cache.get('key19'), 19)
@@ -27,7 +27,7 @@ except NameError:
         return False
 
 # put tests in here to be included in the testing suite
-__all__ = ['MultiDbTest', 'SingleModelTest', 'MultiModelTest', 'TransactionSupportTest', 'BlackListTest', 'TransactionManagerTestCase', 'TransactionCacheTestCase']
+__all__ = ['MultiDbTest', 'SingleModelTest', 'MultiModelTest', 'TransactionSupportTest', 'BlackListTest', 'TransactionManagerTestCase', 'TransactionCacheTestCase', 'TransactionCacheThreadingTest', 'TransactionManagerAliasTest', 'CreateGenerationsTest', 'SingleFlightTest', 'CircuitBreakerBypassTest', 'RowCacheTest', 'ObjectCacheTest', 'SliceCacheTest', 'CountCacheTest', 'BatchPrefetchTest', 'BatchTest', 'NewGenerationTest', 'SpeculativeFetchTest', 'QueryTablesTest', 'CompileCacheTest', 'TableFilterTest']
 
 def _pre_setup(self):
     self.saved_DISABLE_SETTING = getattr(johnny_settings, 'DISABLE_QUERYSET_CACHE', False)
@@ -969,6 +969,7 @@ class TransactionManagerTestCase(base.TransactionJohnnyTestCase):
 class TransactionCacheTestCase(base.JohnnyTestCase):
     def setUp(self):
         self.backend = LocMemCache('', {})
+        self.backend.clear()
         self.cache = TransactionCache(self.backend)
         self.cache.timeout = 1000
 
@@ -1030,11 +1031,32 @@ class TransactionCacheTestCase(base.JohnnyTestCase):
 
     def test_rollback(self):
         self.backend.set('a', '1')
+        self.cache.set('b', '2')
         self.assertEqual(self.cache.get('a'), '1')
+        self.cache.rollback()
+        self.assertIsNone(self.cache.get('b'))
+        # the local read cache survives a rollback
         self.backend.set('a', '2')
         self.assertEqual(self.cache.get('a'), '1')
+
+    def test_rollback_drops_shadowed_reads(self):
+        self.backend.set('a', '1')
+        self.assertEqual(self.cache.get('a'), '1')
+        self.cache.savepoint('sp')
+        self.cache.set('a', '2')
+        self.backend.set('a', '3')
         self.cache.rollback()
+        self.assertEqual(self.cache.get('a'), '3')
+        self.assertRaises(IndexError, self.cache.rollback_savepoint, 'sp')
+
+    def test_clear(self):
+        self.backend.set('a', '1')
+        self.cache.set('b', '2')
+        self.assertEqual(self.cache.get('a'), '1')
+        self.backend.set('a', '2')
+        self.cache.clear()
         self.assertEqual(self.cache.get('a'), '2')
+        self.assertIsNone(self.cache.get('b'))
 
     def test_commit(self):
         self.backend.set('a', '1')
@@ -1047,6 +1069,14 @@ class TransactionCacheTestCase(base.JohnnyTestCase):
         self.assertEqual(self.backend.get('a'), '3')
         self.assertIsNone(self.backend.get('b'))
 
+    def test_commit_clears_reads(self):
+        self.backend.set('a', '1')
+        self.assertEqual(self.cache.get('a'), '1')
+        self.backend.set('a', '2')
+        self.cache.set('b', '3')
+        self.cache.commit()
+        self.assertEqual(self.cache.get('a'), '2')
+
     def test_rollback_savepoint(self):
         self.cache.set('a', '1')
         self.cache.savepoint('sp1')
@@ -1115,3 +1145,971 @@ class TransactionCacheTestCase(base.JohnnyTestCase):
         self.assertEqual(self.cache.get('a'), '1')
 
         self.assertRaises(IndexError, self.cache.rollback_savepoint, 'sp')
+
+
+    def test_commit_savepoint_then_rollback_enclosing(self):
+        self.cache.set('a', '1')
+        self.cache.savepoint('sp1')
+        self.cache.set('a', '2')
+        self.cache.savepoint('sp2')
+        self.cache.set('a', '3')
+        self.cache.set('b', '3')
+        self.cache.commit_savepoint('sp2')
+        self.assertEqual(self.cache.get('a'), '3')
+        self.cache.rollback_savepoint('sp1')
+        self.assertEqual(self.cache.get('a'), '1')
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_deep_savepoints(self):
+        for depth in range(10):
+            self.cache.set('a', str(depth))
+            self.cache.set('depth%d' % depth, 'x')
+            self.cache.savepoint('sp%d' % depth)
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.rollback_savepoint('sp5')
+        self.assertEqual(self.cache.get('a'), '5')
+        self.assertEqual(self.cache.get('depth5'), 'x')
+        self.assertIsNone(self.cache.get('depth6'))
+        self.cache.commit()
+        self.assertEqual(self.backend.get('a'), '5')
+        self.assertEqual(self.backend.get('depth0'), 'x')
+        self.assertIsNone(self.backend.get('depth6'))
+
+    def test_bounded_local_cache(self):
+        from johnny.datastructures import LRUCache
+        self.cache.local_cache = LRUCache(max_size=3, sizeof=len)
+        self.backend.set_many({'a': '1', 'b': '2', 'c': '3', 'd': '4'})
+        self.cache.set('dirty', 'x' * 10)
+        self.cache.get_many(['a', 'b', 'c'])
+        self.assertEqual(self.cache.local_size, 3)
+        self.cache.get('d')
+        self.assertEqual(self.cache.local_size, 3)
+        self.failIf('a' in self.cache.local_cache)
+        # dirty values are never evicted
+        self.assertEqual(self.cache.get('dirty'), 'x' * 10)
+        self.cache.commit()
+        self.assertEqual(self.backend.get('dirty'), 'x' * 10)
+
+class TransactionCacheThreadingTest(base.JohnnyTestCase):
+    def setUp(self):
+        from johnny.cache import KeyGen
+        from johnny.transaction import TransactionManager
+        self.backend = LocMemCache('', {})
+        self.backend.clear()
+        self.manager = TransactionManager(self.backend, KeyGen)
+
+    def test_thread_local_cache(self):
+        from threading import Thread
+        caches = []
+        def run():
+            caches.append(self.manager.tx_cache)
+        t = Thread(target=run)
+        t.start()
+        t.join()
+        self.failUnless(self.manager.tx_cache is self.manager.tx_cache)
+        self.failUnless(caches[0] is not self.manager.tx_cache)
+
+    def test_interleaved_commits_and_rollbacks(self):
+        from random import Random
+        from threading import Thread
+        errors = []
+
+        def run(n):
+            tx_cache = self.manager.tx_cache
+            tx_cache.timeout = 1000
+            rand = Random(n)
+            mine = 'thread%d' % n
+            try:
+                for i in range(200):
+                    value = '%s-%d' % (mine, i)
+                    tx_cache.set('shared', value)
+                    tx_cache.set(mine, value)
+                    tx_cache.savepoint('sp')
+                    tx_cache.set('shared', 'dirty')
+                    if tx_cache.get('shared') != 'dirty':
+                        errors.append((mine, 'savepoint'))
+                    tx_cache.rollback_savepoint('sp')
+                    if tx_cache.get('shared') != value:
+                        errors.append((mine, 'rollback_savepoint'))
+                    if rand.random() < 0.5:
+                        tx_cache.commit()
+                        if self.backend.get(mine) != value:
+                            errors.append((mine, 'commit'))
+                    else:
+                        tx_cache.rollback()
+                        if tx_cache.get(mine) == value:
+                            errors.append((mine, 'rollback'))
+            except Exception, e:
+                errors.append((mine, repr(e)))
+
+        threads = [Thread(target=run, args=(n,)) for n in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+class TransactionManagerAliasTest(base.JohnnyTestCase):
+    def setUp(self):
+        from johnny.cache import KeyGen
+        from johnny.transaction import TransactionManager
+        self.backend = LocMemCache('', {})
+        self.backend.clear()
+        self.manager = TransactionManager(self.backend, KeyGen)
+        for using in ('default', 'second'):
+            self.manager.get_tx_cache(using).timeout = 1000
+
+    def test_separate_caches(self):
+        default = self.manager.get_tx_cache('default')
+        self.failUnless(self.manager.get_tx_cache() is default)
+        self.failUnless(self.manager.tx_cache is default)
+        self.failUnless(self.manager.get_tx_cache('second') is not default)
+
+    def test_commit_only_flushes_alias(self):
+        self.manager.get_tx_cache('default').set('a', '1')
+        self.manager.get_tx_cache('second').set('b', '2')
+        self.manager.commit(using='second')
+        self.assertIsNone(self.backend.get('a'))
+        self.assertEqual(self.backend.get('b'), '2')
+        self.assertEqual(self.manager.get('a', using='default'), '1')
+        self.manager.commit(using='default')
+        self.assertEqual(self.backend.get('a'), '1')
+
+    def test_rollback_only_drops_alias(self):
+        self.manager.get_tx_cache('default').set('a', '1')
+        self.manager.get_tx_cache('second').set('a', '2')
+        self.manager.rollback(using='second')
+        self.assertEqual(self.manager.get('a', using='default'), '1')
+        self.assertIsNone(self.manager.get('a', using='second'))
+
+    def test_savepoints_per_alias(self):
+        self.manager.get_tx_cache('second').set('a', '1')
+        self.manager._create_savepoint('sp', using='second')
+        self.manager.get_tx_cache('second').set('a', '2')
+        self.assertRaises(IndexError, self.manager._rollback_savepoint, 'sp')
+        self.manager._rollback_savepoint('sp', using='second')
+        self.assertEqual(self.manager.get('a', using='second'), '1')
+
+    def test_shared_cache_key(self):
+        with patch.object(johnny_settings, 'DB_CACHE_KEYS',
+                          {'default': 'default', 'second': 'default'}):
+            self.manager.clear()
+            default = self.manager.get_tx_cache('default')
+            second = self.manager.get_tx_cache('second')
+            self.failUnless(default.local_cache is second.local_cache)
+        second.timeout = 1000
+        self.backend.set('a', '1')
+        self.assertEqual(self.manager.get('a', using='default'), '1')
+        second.set('a', '2')
+        self.assertEqual(self.manager.get('a', using='default'), '1')
+        self.manager.commit(using='second')
+        self.assertEqual(self.manager.get('a', using='default'), '2')
+
+    def test_separate_cache_keys(self):
+        default = self.manager.get_tx_cache('default')
+        second = self.manager.get_tx_cache('second')
+        self.failUnless(default.local_cache is not second.local_cache)
+
+    def test_clear(self):
+        self.manager.get_tx_cache('default').set('a', '1')
+        self.manager.get_tx_cache('second').set('a', '2')
+        self.manager.clear()
+        self.assertIsNone(self.manager.get('a', using='default'))
+        self.assertIsNone(self.manager.get('a', using='second'))
+
+
+class CreateGenerationsTest(base.JohnnyTestCase):
+    def setUp(self):
+        from johnny.cache import KeyGen, KeyHandler
+        from johnny.transaction import TransactionManager
+        self.backend = LocMemCache('', {})
+        self.backend.clear()
+        self.manager = TransactionManager(self.backend, KeyGen)
+        self.keyhandler = KeyHandler(self.manager, KeyGen, 'jc')
+        self.key = self.keyhandler.keygen.gen_table_key('table')
+
+    def test_set(self):
+        self.failIf(hasattr(self.manager, 'get_or_add_many'))
+        with patch.object(self.manager, 'set') as set:
+            generation = self.keyhandler.create_generations([self.key])
+        self.assertEqual(set.call_args[0][:2],
+                         (self.key, generation[self.key]))
+
+    def test_get_or_add_many(self):
+        def get_or_add_many(data, timeout=None):
+            for key, value in data.iteritems():
+                self.backend.add(key, value, 1000)
+            return self.backend.get_many(list(data))
+        self.backend.set(self.key, 'existing', 1000)
+        with patch.object(self.backend, 'get_or_add_many', get_or_add_many,
+                          create=True):
+            self.assertEqual(self.keyhandler.create_generations([self.key]),
+                             {self.key: 'existing'})
+        self.failIf(hasattr(self.manager, 'get_or_add_many'))
+
+
+class SingleFlightTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def _start(self, target, *args):
+        from threading import Thread
+        t = Thread(target=target, args=args)
+        t.start()
+        return t
+
+    def test_concurrent_calls_coalesce(self):
+        from threading import Event
+        from time import sleep
+        from johnny.cache import SingleFlight
+        flights = SingleFlight()
+        release = Event()
+        calls = []
+        results = []
+
+        def query():
+            calls.append(1)
+            release.wait()
+            return ['row']
+
+        def run():
+            results.append(flights.do('key', query))
+
+        threads = [self._start(run)]
+        while not calls:
+            sleep(0.01)
+        threads += [self._start(run) for i in range(4)]
+        sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['row']] * 5)
+        self.assertEqual(flights.stats(), {'executed': 1, 'coalesced': 4})
+        self.assertEqual(flights.flights, {})
+
+    def test_waiters_retry_when_leader_fails(self):
+        from threading import Event
+        from time import sleep
+        from johnny.cache import SingleFlight
+        flights = SingleFlight()
+        release = Event()
+        calls = []
+        results = []
+
+        def query():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait()
+                raise ValueError()
+            return ['row']
+
+        def run():
+            try:
+                results.append(flights.do('key', query))
+            except ValueError:
+                results.append(None)
+
+        threads = [self._start(run)]
+        while not calls:
+            sleep(0.01)
+        threads.append(self._start(run))
+        sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(results), [None, ['row']])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flights.stats()['coalesced'], 0)
+
+    def test_select_path(self):
+        """Queries still hit and miss normally with single-flight enabled."""
+        from johnny.cache import single_flight
+        from testapp.models import Genre
+        old = johnny_settings.SINGLE_FLIGHT
+        johnny_settings.SINGLE_FLIGHT = True
+        try:
+            single_flight.reset()
+            q = base.message_queue()
+            connection.queries = []
+            first = list(Genre.objects.all())
+            second = list(Genre.objects.all())
+            self.assertEqual(first, second)
+            self.assertEqual((q.get_nowait(), q.get_nowait()), (False, True))
+            self.assertEqual(len(connection.queries), 1)
+            self.assertEqual(single_flight.stats()['executed'], 1)
+        finally:
+            johnny_settings.SINGLE_FLIGHT = old
+
+
+class CircuitBreakerBypassTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def test_open_breaker_bypasses_the_cache(self):
+        from johnny import cache
+        from testapp.models import Genre
+        manager = cache.get_backend().cache_backend
+        q = base.message_queue()
+        with patch.object(manager, '_is_open', lambda: True):
+            connection.queries = []
+            list(Genre.objects.all())
+            list(Genre.objects.all())
+            self.assertEqual(len(connection.queries), 2)
+            self.failUnless(q.empty())
+        connection.queries = []
+        list(Genre.objects.all())
+        list(Genre.objects.all())
+        self.assertEqual(len(connection.queries), 1)
+
+
+class RowCacheTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.row_cache = johnny_settings.ROW_CACHE
+        johnny_settings.ROW_CACHE = True
+
+    def tearDown(self):
+        johnny_settings.ROW_CACHE = self.row_cache
+
+    def test_selects_only_missing_rows(self):
+        from testapp.models import Genre
+        genres = Genre.objects.order_by()
+        connection.queries = []
+        self.assertEqual([g.pk for g in genres.filter(pk__in=[2, 1])], [2, 1])
+        self.assertEqual(len(connection.queries), 1)
+        # 1 and 2 are cached, 3 isn't and 100 doesn't exist
+        self.assertEqual([g.pk for g in genres.filter(pk__in=[3, 1, 100, 2])],
+                         [3, 1, 2])
+        self.assertEqual(len(connection.queries), 2)
+        self.failUnless(connection.queries[1]['sql'].endswith('IN (3, 100)'))
+        self.assertEqual([g.pk for g in
+                          Genre.objects.filter(pk__in=[1, 2, 3, 100])
+                                       .order_by('-pk')], [3, 2, 1])
+        self.assertEqual(len(connection.queries), 2)
+
+    def test_signals_send_the_query(self):
+        from johnny.signals import qc_hit, qc_miss
+        from testapp.models import Genre
+        sent = []
+        def listener(signal, **kwargs):
+            sent.append((signal, kwargs['query'], kwargs['key']))
+        qc_hit.connect(listener)
+        qc_miss.connect(listener)
+        genres = Genre.objects.filter(pk__in=[1, 2]).order_by()
+        try:
+            list(genres)
+            list(genres.all())
+        finally:
+            qc_hit.disconnect(listener)
+            qc_miss.disconnect(listener)
+        compiler = genres.query.get_compiler('default')
+        sql, params = compiler.as_sql()
+        query = (sql, params, compiler.query.ordering_aliases)
+        self.assertEqual(sent, [(qc_miss, query, None), (qc_hit, query, None)])
+
+    def test_primary_keys_written_another_way(self):
+        from johnny.cache import QueryCacheBackend
+        from testapp.models import Genre
+        original = QueryCacheBackend._select_missing
+        def select_missing(backend, cls, original_fn, pks):
+            return [(unicode(row[0]),) + tuple(row[1:]) for row in
+                    original(backend, cls, original_fn, pks)]
+        with patch.object(QueryCacheBackend, '_select_missing',
+                          select_missing):
+            self.assertEqual([int(g.pk) for g in Genre.objects.filter(
+                pk__in=[1, 2]).order_by()], [1, 2])
+        connection.queries = []
+        # the rows were cached under the keys asked for
+        self.assertEqual([int(g.pk) for g in Genre.objects.filter(
+            pk__in=[2, 1]).order_by()], [2, 1])
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_rows_for_other_primary_keys(self):
+        from johnny.cache import QueryCacheBackend
+        from testapp.models import Genre
+        def select_missing(backend, cls, original_fn, pks):
+            # as a case-insensitive match of another spelling would
+            return list(Genre.objects.filter(pk=3).values_list())
+        connection.queries = []
+        with patch.object(QueryCacheBackend, '_select_missing',
+                          select_missing):
+            self.assertEqual([g.pk for g in Genre.objects.filter(
+                pk__in=[1]).order_by()], [1])
+        # nothing, not even that there is no row 1, was cached
+        johnny_settings.OBJECT_CACHE, old = True, johnny_settings.OBJECT_CACHE
+        try:
+            self.assertEqual(Genre.objects.get(pk=1).pk, 1)
+        finally:
+            johnny_settings.OBJECT_CACHE = old
+        self.assertEqual(Genre.objects.filter(pk__in=[1]).order_by()[0].pk, 1)
+
+    def test_rows_are_invalidated(self):
+        from testapp.models import Genre
+        genres = Genre.objects.order_by('pk')
+        titles = [g.title for g in genres.filter(pk__in=[1, 2])]
+        genre = Genre.objects.get(pk=1)
+        genre.title = 'Changed'
+        genre.save()
+        connection.queries = []
+        self.assertEqual([g.title for g in genres.filter(pk__in=[1, 2])],
+                         ['Changed', titles[1]])
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_other_queries_are_not_affected(self):
+        from johnny.cache import get_pk_in_lookup
+        from testapp.models import Genre
+        for qs in (Genre.objects.filter(pk__in=[1, 2]),
+                   Genre.objects.filter(pk__in=[1, 2], title='x').order_by(),
+                   Genre.objects.exclude(pk__in=[1, 2]).order_by(),
+                   Genre.objects.filter(pk__in=[1, 2]).order_by()[:1],
+                   Genre.objects.filter(pk__in=[1, 2]).order_by().only('id')):
+            qs.query.get_compiler('default').as_sql()
+            self.assertIsNone(get_pk_in_lookup(qs.query))
+
+
+class ObjectCacheTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.settings = johnny_settings.OBJECT_CACHE, johnny_settings.ROW_CACHE
+        johnny_settings.OBJECT_CACHE = johnny_settings.ROW_CACHE = True
+
+    def tearDown(self):
+        johnny_settings.OBJECT_CACHE, johnny_settings.ROW_CACHE = self.settings
+
+    def test_hit_skips_compiling(self):
+        from django.db.models.sql.compiler import SQLCompiler
+        from testapp.models import Genre
+        connection.queries = []
+        genre = Genre.objects.get(pk=1)
+        self.assertEqual(len(connection.queries), 1)
+        with patch.object(SQLCompiler, 'as_sql') as as_sql:
+            self.assertEqual(Genre.objects.get(pk=1), genre)
+            self.assertEqual(Genre.objects.get(id='1').title, genre.title)
+            self.failIf(as_sql.called)
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_missing_object(self):
+        from testapp.models import Genre
+        connection.queries = []
+        self.assertRaises(Genre.DoesNotExist, Genre.objects.get, pk=100)
+        self.assertRaises(Genre.DoesNotExist, Genre.objects.get, pk=100)
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_save_invalidates(self):
+        from testapp.models import Genre
+        genre = Genre.objects.get(pk=1)
+        genre.title = 'Changed'
+        genre.save()
+        connection.queries = []
+        self.assertEqual(Genre.objects.get(pk=1).title, 'Changed')
+        self.assertEqual(len(connection.queries), 1)
+        Genre.objects.filter(pk=1).update(title='Updated')
+        self.assertEqual(Genre.objects.get(pk=1).title, 'Updated')
+        Genre.objects.get(pk=1).delete()
+        self.assertRaises(Genre.DoesNotExist, Genre.objects.get, pk=1)
+
+    def test_signals_send_the_query(self):
+        from johnny.signals import qc_hit, qc_miss
+        from testapp.models import Genre
+        sent = []
+        def listener(signal, **kwargs):
+            sent.append((signal, kwargs['query']))
+        qc_hit.connect(listener)
+        qc_miss.connect(listener)
+        try:
+            Genre.objects.get(pk=1)
+            Genre.objects.get(pk=1)
+        finally:
+            qc_hit.disconnect(listener)
+            qc_miss.disconnect(listener)
+        compiler = Genre.objects.filter(pk=1).order_by().query.get_compiler(
+            'default')
+        sql, params = compiler.as_sql()
+        query = (sql, params, compiler.query.ordering_aliases)
+        self.assertEqual(sent, [(qc_miss, query), (qc_hit, query)])
+
+    def test_shared_with_row_cache(self):
+        from testapp.models import Genre
+        Genre.objects.get(pk=1)
+        Genre.objects.get(pk=2)
+        connection.queries = []
+        self.assertEqual([g.pk for g in
+                          Genre.objects.filter(pk__in=[2, 1]).order_by()],
+                         [2, 1])
+        self.assertEqual(len(connection.queries), 0)
+
+
+class SliceCacheTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.settings = (johnny_settings.SLICE_CACHE,
+                         johnny_settings.SLICE_CACHE_ROWS)
+        johnny_settings.SLICE_CACHE = True
+
+    def tearDown(self):
+        (johnny_settings.SLICE_CACHE,
+         johnny_settings.SLICE_CACHE_ROWS) = self.settings
+
+    def test_slices_of_cached_result(self):
+        from testapp.models import Genre
+        genres = list(Genre.objects.all())
+        connection.queries = []
+        self.assertEqual(list(Genre.objects.all()[:2]), genres[:2])
+        self.assertEqual(list(Genre.objects.all()[1:]), genres[1:])
+        self.assertEqual(Genre.objects.all()[2], genres[2])
+        self.assertEqual(list(Genre.objects.all()[5:10]), [])
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(list(Genre.objects.order_by('-title')[:1]),
+                         genres[-1:])
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_caches_small_results(self):
+        from testapp.models import Genre
+        johnny_settings.SLICE_CACHE_ROWS = 10
+        connection.queries = []
+        first = list(Genre.objects.all()[:1])
+        self.assertEqual(len(connection.queries), 1)
+        genres = list(Genre.objects.all())
+        self.assertEqual(first, genres[:1])
+        self.assertEqual(list(Genre.objects.all()[1:3]), genres[1:3])
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_skips_lookup_under_new_generation(self):
+        from johnny import cache
+        from testapp.models import Genre
+        manager = cache.get_backend().cache_backend
+        manager.cache_backend.clear()
+        manager.clear()
+        with patch.object(manager, 'get', wraps=manager.get) as get:
+            list(Genre.objects.all()[:1])
+        self.assertEqual([args[0] for args, kwargs in get.call_args_list],
+                         [manager.keygen.gen_table_key('testapp_genre')])
+
+    def test_large_results_are_not_cached(self):
+        from johnny.cache import invalidate
+        from testapp.models import Genre
+        johnny_settings.SLICE_CACHE_ROWS = 1
+        genres = list(Genre.objects.order_by('pk'))
+        # so that the result isn't cached already
+        invalidate(Genre)
+        connection.queries = []
+        self.assertEqual(list(Genre.objects.order_by('pk')[:1]), genres[:1])
+        self.assertEqual(len(connection.queries), 1)
+        self.assertEqual(list(Genre.objects.order_by('pk')[:1]), genres[:1])
+        self.assertEqual(len(connection.queries), 1)
+        self.assertEqual(list(Genre.objects.order_by('pk')[1:3]), genres[1:3])
+        self.assertEqual(len(connection.queries), 3)
+
+
+class CountCacheTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.count_cache = johnny_settings.COUNT_CACHE
+        johnny_settings.COUNT_CACHE = True
+
+    def tearDown(self):
+        johnny_settings.COUNT_CACHE = self.count_cache
+
+    def test_count_and_exists_of_cached_rows(self):
+        from testapp.models import Book
+        books = Book.objects.filter(title__contains='and')
+        titles = list(books.values_list('title', flat=True))
+        connection.queries = []
+        self.assertEqual(books.count(), len(titles))
+        self.assertEqual(books.exists(), bool(titles))
+        self.assertEqual(books.order_by('-title').count(), len(titles))
+        self.assertEqual(books[1:].count(), max(len(titles) - 1, 0))
+        nothing = Book.objects.filter(title='Nothing')
+        list(nothing)
+        self.failIf(nothing.exists())
+        self.assertEqual(nothing.count(), 0)
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_different_conditions(self):
+        from testapp.models import Book
+        list(Book.objects.filter(title__contains='and'))
+        connection.queries = []
+        Book.objects.filter(title__startswith='A').count()
+        Book.objects.filter(title__contains='and').distinct().count()
+        self.assertEqual(len(connection.queries), 2)
+
+    def test_invalidated_with_the_rows(self):
+        from testapp.models import Genre
+        count = len(list(Genre.objects.all()))
+        Genre.objects.create(title='New', slug='new')
+        self.assertEqual(Genre.objects.count(), count + 1)
+
+
+class BatchPrefetchTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.batch_prefetch = johnny_settings.BATCH_PREFETCH
+
+    def tearDown(self):
+        johnny_settings.BATCH_PREFETCH = self.batch_prefetch
+
+    def test_prefetch_tables(self):
+        from johnny.cache import get_prefetch_tables
+        from testapp.models import Publisher
+        self.assertEqual(sorted(get_prefetch_tables(Publisher,
+                                    ['book_set__genre', 'book_set__authors'])),
+                         ['testapp_book', 'testapp_book_authors',
+                          'testapp_book_genre', 'testapp_genre',
+                          'testapp_person', 'testapp_publisher'])
+
+    def test_pinned_generations(self):
+        from johnny import cache
+        keyhandler = cache.get_backend().keyhandler
+        generation = keyhandler.get_generation('testapp_genre')
+        with keyhandler.pinned_generations(['testapp_genre']) as pinned:
+            self.assertEqual(pinned.values(), [generation])
+            new = keyhandler.invalidate_table('testapp_genre')
+            self.assertEqual(keyhandler.get_generation('testapp_genre'), new)
+        self.assertEqual(keyhandler.get_generation('testapp_genre'), new)
+
+    def _lookups(self, batch):
+        from johnny import cache
+        from testapp.models import Publisher
+        if not hasattr(Publisher.objects, 'prefetch_related'):
+            return None, 0
+        johnny_settings.BATCH_PREFETCH = batch
+        manager = cache.get_backend().cache_backend
+        qs = Publisher.objects.prefetch_related('book_set__genre',
+                                                'book_set__authors')
+        list(qs.all())
+        connection.queries = []
+        with patch.object(manager, 'get', wraps=manager.get) as get:
+            with patch.object(manager, 'get_many',
+                              wraps=manager.get_many) as get_many:
+                publishers = list(qs.all())
+        self.assertEqual(len(connection.queries), 0)
+        result = [(p.pk, [(b.pk, [g.pk for g in b.genre.all()],
+                           [a.pk for a in b.authors.all()])
+                          for b in p.book_set.all()])
+                  for p in publishers]
+        return result, get.call_count + get_many.call_count
+
+    def test_fewer_round_trips(self):
+        result, lookups = self._lookups(False)
+        batched_result, batched_lookups = self._lookups(True)
+        self.assertEqual(result, batched_result)
+        if result is not None:
+            # one get_many instead of one for each of the three queries
+            self.assertEqual(batched_lookups, lookups - 2)
+
+
+class BatchTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def test_batch(self):
+        from johnny import cache
+        from testapp.models import Genre, Book, Publisher
+        genres = list(Genre.objects.all())
+        books = list(Book.objects.filter(publisher__isnull=False))
+        manager = cache.get_backend().cache_backend
+        q = base.message_queue()
+        connection.queries = []
+        querysets = (Genre.objects.all(),
+                     Book.objects.filter(publisher__isnull=False),
+                     Publisher.objects.all())
+        with patch.object(manager, 'get', wraps=manager.get) as get:
+            with patch.object(manager, 'get_many',
+                              wraps=manager.get_many) as get_many:
+                self.assertEqual(cache.batch(*querysets), querysets)
+        self.assertEqual((get.call_count, get_many.call_count), (0, 2))
+        # only the publishers went to the database
+        self.assertEqual(len(connection.queries), 1)
+        self.assertEqual([q.get_nowait() for i in range(3)],
+                         [True, True, False])
+        self.assertEqual(querysets[0]._result_cache, genres)
+        self.assertEqual(querysets[1]._result_cache, books)
+        self.assertEqual(list(querysets[2]), list(Publisher.objects.all()))
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_unpatched(self):
+        from johnny import cache
+        from testapp.models import Genre
+        cache.get_backend().unpatch()
+        qs = Genre.objects.all()
+        cache.batch(qs)
+        self.failIf(qs._result_cache is None)
+
+
+class NewGenerationTest(QueryCacheBase):
+    def test_generation_info(self):
+        from johnny import cache
+        keyhandler = cache.get_backend().keyhandler
+        keyhandler.cache_backend.cache_backend.clear()
+        keyhandler.cache_backend.clear()
+        generation, minted = keyhandler.get_generation_info('testapp_milk')
+        self.failUnless(minted)
+        self.assertEqual(keyhandler.get_generation_info('testapp_milk'),
+                         (generation, False))
+        self.failUnless(keyhandler.get_generation_info(
+            'testapp_milk', 'testapp_issue24model')[1])
+        self.failIf(keyhandler.get_generation_info(
+            'testapp_milk', 'testapp_issue24model')[1])
+
+    def test_skips_result_lookup(self):
+        from johnny import cache
+        from testapp.models import Issue24Model
+        manager = cache.get_backend().cache_backend
+        manager.cache_backend.clear()
+        manager.clear()
+        q = base.message_queue()
+        with patch.object(manager, 'get', wraps=manager.get) as get:
+            list(Issue24Model.objects.all())
+        self.assertEqual([args[0] for args, kwargs in get.call_args_list],
+                         [manager.keygen.gen_table_key('testapp_issue24model')])
+        self.failIf(q.get_nowait())
+        list(Issue24Model.objects.all())
+        self.failUnless(q.get_nowait())
+
+
+class SpeculativeFetchTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        from johnny.cache import speculation
+        self.speculative_fetch = johnny_settings.SPECULATIVE_FETCH
+        johnny_settings.SPECULATIVE_FETCH = True
+        speculation.reset()
+
+    def tearDown(self):
+        johnny_settings.SPECULATIVE_FETCH = self.speculative_fetch
+
+    def _evaluate(self, qs):
+        from johnny import cache
+        manager = cache.get_backend().cache_backend
+        with patch.object(manager, 'get', wraps=manager.get) as get:
+            with patch.object(manager, 'get_many',
+                              wraps=manager.get_many) as get_many:
+                result = list(qs)
+        return result, get.call_count + get_many.call_count
+
+    def test_one_round_trip(self):
+        from johnny.cache import speculation
+        from testapp.models import Genre, Book
+        genres, round_trips = self._evaluate(Genre.objects.all())
+        self.assertEqual(round_trips, 2)
+        self.assertEqual(self._evaluate(Genre.objects.all()), (genres, 1))
+        list(Book.objects.filter(genre__title__startswith='A'))
+        connection.queries = []
+        self.assertEqual(self._evaluate(
+            Book.objects.filter(genre__title__startswith='A'))[1], 1)
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(speculation.stats(),
+                         {'hits': 2, 'misses': 0, 'hit_rate': 1.0})
+
+    def test_wrong_guess(self):
+        from johnny.cache import speculation
+        from testapp.models import Genre
+        genres = list(Genre.objects.all())
+        key = speculation.generations.keys()[0]
+        speculation.generations[key] = 'wrong'
+        q = base.message_queue()
+        connection.queries = []
+        self.assertEqual(self._evaluate(Genre.objects.all()), (genres, 2))
+        self.failUnless(q.get_nowait())
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(speculation.stats()['misses'], 1)
+        self.assertEqual(self._evaluate(Genre.objects.all()), (genres, 1))
+
+    def test_invalidation(self):
+        from testapp.models import Genre
+        list(Genre.objects.all())
+        Genre.objects.create(title='New', slug='new')
+        genres, round_trips = self._evaluate(Genre.objects.all())
+        self.failUnless('New' in [g.title for g in genres])
+
+
+class QueryTablesTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        from johnny.cache import query_tables
+        query_tables.clear()
+
+    def test_walks_once_per_statement(self):
+        from johnny import cache
+        from testapp.models import Publisher, Book
+        pubs = Publisher.objects.filter(title__startswith='A')
+        books = Book.objects.filter(publisher__in=pubs)
+        with patch.object(cache, 'get_tables_for_query',
+                          wraps=cache.get_tables_for_query) as walk:
+            list(books)
+            self.assertEqual(walk.call_count, 2)
+            walk.reset_mock()
+            list(books.all())
+            self.assertEqual(walk.call_count, 0)
+        sql = books.query.get_compiler('default').as_sql()[0]
+        self.assertEqual(sorted(cache.query_tables.get(books.query, sql)),
+                         ['testapp_book', 'testapp_publisher'])
+
+    def test_bounded(self):
+        from johnny.cache import QueryTables
+        from testapp.models import Genre
+        query_tables = QueryTables(2)
+        for i in range(3):
+            query = Genre.objects.filter(id=i).query
+            query_tables.get(query, 'sql %d' % i)
+        self.assertEqual(len(query_tables.lru), 2)
+        self.failIf('sql 0' in query_tables.lru)
+
+
+class CompileCacheTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        from johnny.cache import CompiledQueries
+        self.compiled = CompiledQueries(100)
+
+    def _compiler(self, qs):
+        return qs.query.get_compiler(qs.db)
+
+    def _shapes(self, value):
+        from datetime import date
+        from django.db.models import Q
+        from testapp.models import Book, Genre
+        return [
+            Genre.objects.all(),
+            Genre.objects.filter(title__startswith=value).order_by('-slug'),
+            Genre.objects.filter(id__in=[len(value), len(value) + 1]),
+            Book.objects.filter(Q(title=value) | Q(slug__icontains=value)),
+            Book.objects.exclude(publisher__title=value)[1:3],
+            Book.objects.filter(published__year=len(value) + 2000,
+                                published__lt=date(2010, 1, len(value))),
+            Book.objects.filter(publisher__isnull=True, title=value),
+        ]
+
+    def test_same_sql_as_compiling(self):
+        from johnny.cache import get_tables_for_query
+        for qs in self._shapes('A'):
+            self.compiled.compile(self._compiler(qs))
+        for qs, other in zip(self._shapes('Bee'), self._shapes('Bee')):
+            compiler = self._compiler(qs)
+            compiler.as_sql = None
+            sql, params, ordering, tables = self.compiled.compile(compiler)
+            other = self._compiler(other)
+            self.assertEqual((sql, params), other.as_sql())
+            self.assertEqual(ordering, other.get_ordering())
+            self.assertEqual(sorted(tables),
+                             sorted(get_tables_for_query(other.query)))
+
+    def test_results(self):
+        from testapp.models import Genre
+        from johnny import cache
+        with patch.object(cache, 'compiled_queries', self.compiled):
+            for genre in Genre.objects.all():
+                self.assertEqual(list(Genre.objects.filter(id=genre.id)),
+                                 [genre])
+            self.assertEqual(list(Genre.objects.filter(id__in=[])), [])
+            self.assertEqual(list(Genre.objects.all()[0:0]), [])
+        self.assertEqual(len(self.compiled.lru), 2)
+
+    def test_tables_joined_by_ordering(self):
+        from testapp.models import Book, Publisher
+        from johnny import cache
+        publisher = Publisher.objects.filter(book__isnull=False)[0]
+        qs = Book.objects.filter(id__gt=0).order_by('publisher__title')
+        with patch.multiple(cache, compiled_queries=self.compiled,
+                            query_tables=cache.QueryTables(0)):
+            list(qs.all())
+            connection.queries = []
+            list(qs.all())
+            self.assertEqual(len(connection.queries), 0)
+            Publisher.objects.filter(pk=publisher.pk).update(title='zzz')
+            connection.queries = []
+            self.assertEqual(list(qs.all()), list(
+                Book.objects.filter(id__gt=0).order_by('publisher__title')))
+            self.assertEqual(len(connection.queries), 1)
+
+    def test_uncacheable(self):
+        from django.db.models import Count, F
+        from johnny.cache import get_query_signature
+        from testapp.models import Book, Publisher
+        for qs in [Book.objects.filter(publisher__in=Publisher.objects.all()),
+                   Book.objects.filter(pages__gt=F('id')),
+                   Book.objects.extra(where=['pages > 1']),
+                   Book.objects.annotate(Count('authors')),
+                   Book.objects.select_related('publisher')]:
+            self.assertEqual(get_query_signature(self._compiler(qs)), None)
+
+
+class TableFilterTest(base.JohnnyTestCase):
+    def _filter(self, blacklist=(), whitelist=()):
+        from johnny.cache import TableFilter
+        table_filter = TableFilter()
+        self.settings = patch.multiple(johnny_settings,
+                                       BLACKLIST=set(blacklist),
+                                       WHITELIST=set(whitelist))
+        self.settings.start()
+        self.addCleanup(self.settings.stop)
+        table_filter.prepare()
+        return table_filter
+
+    def test_blacklist(self):
+        table_filter = self._filter(['testapp_genre', 'testapp_book_*'])
+        self.failUnless(table_filter.disallowed(('testapp_genre',)))
+        self.failUnless(table_filter.disallowed(('testapp_book_authors',)))
+        self.failUnless(table_filter.disallowed(('testapp_book',
+                                                 'testapp_genre')))
+        self.failIf(table_filter.disallowed(('testapp_book',)))
+        self.failIf(table_filter.disallowed(('testapp_book', 'not_a_model')))
+        self.failUnless(table_filter.disallowed(('testapp_book_raw',)))
+        self.failIf(table_filter.disallowed(()))
+
+    def test_app_label(self):
+        table_filter = self._filter(['testapp.*'])
+        self.failUnless(table_filter.disallowed(('testapp_book',)))
+        self.failUnless(table_filter.disallowed(('testapp_book_authors',)))
+        self.failIf(table_filter.disallowed(('testapp_not_a_model',)))
+
+    def test_whitelist(self):
+        table_filter = self._filter(['testapp_genre'], ['testapp_*'])
+        self.failIf(table_filter.disallowed(('testapp_genre',
+                                             'testapp_book')))
+        self.failUnless(table_filter.disallowed(('testapp_book',
+                                                 'auth_user')))
+
+    def test_unknown_app(self):
+        from django.core.exceptions import ImproperlyConfigured
+        self.assertRaises(ImproperlyConfigured, self._filter, ['nope.*'])
+
+    def test_replaced_lists(self):
+        table_filter = self._filter()
+        tables = ('testapp_genre', 'testapp_book')
+        self.failIf(table_filter.disallowed(tables))
+        johnny_settings.BLACKLIST = set(['testapp_book'])
+        self.failUnless(table_filter.disallowed(tables))
+        johnny_settings.WHITELIST = set(['testapp_genre', 'testapp_book'])
+        self.failIf(table_filter.disallowed(tables))
+
+    def test_changed_lists(self):
+        table_filter = self._filter()
+        tables = ('testapp_genre', 'testapp_book')
+        self.failIf(table_filter.disallowed(tables))
+        johnny_settings.BLACKLIST.add('testapp_book')
+        self.failUnless(table_filter.disallowed(tables))
+        johnny_settings.WHITELIST.update(['testapp_genre', 'testapp_book'])
+        self.failIf(table_filter.disallowed(tables))
+        johnny_settings.WHITELIST.discard('testapp_book')
+        self.failUnless(table_filter.disallowed(tables))
+
+    def test_lists_that_are_not_sets(self):
+        table_filter = self._filter()
+        johnny_settings.BLACKLIST = ['testapp_book']
+        tables = ('testapp_genre', 'testapp_book')
+        self.failUnless(table_filter.disallowed(tables))
+        state = table_filter.state
+        self.failUnless(table_filter.disallowed(tables))
+        self.failUnless(table_filter.state is state)
+        johnny_settings.BLACKLIST.remove('testapp_book')
+        self.failIf(table_filter.disallowed(tables))
+
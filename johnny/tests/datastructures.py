@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for johnny's in-process cache data structures."""
+
+from django.test import TestCase
+from johnny.datastructures import LRUCache, approximate_size
+
+class LRUCacheTest(TestCase):
+    def test_dict_api(self):
+        lru = LRUCache()
+        lru['a'] = 1
+        lru.update({'b': 2, 'c': 3})
+        self.assertEqual(len(lru), 3)
+        self.assertEqual(lru['a'], 1)
+        self.assertEqual(lru.get('missing', 4), 4)
+        self.failUnless('b' in lru)
+        self.assertEqual(lru.pop('b'), 2)
+        self.assertEqual(lru.pop('b', None), None)
+        self.assertRaises(KeyError, lru.pop, 'b')
+        del lru['c']
+        self.assertEqual(sorted(lru), ['a'])
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+        self.assertEqual(lru.size, 0)
+
+    def test_size_accounting(self):
+        lru = LRUCache(sizeof=len)
+        lru['a'] = 'xxx'
+        lru['b'] = 'yy'
+        self.assertEqual(lru.size, 5)
+        lru['a'] = 'x'
+        self.assertEqual(lru.size, 3)
+        lru.pop('b')
+        self.assertEqual(lru.size, 1)
+
+    def test_unbounded_values_measured_on_demand(self):
+        measured = []
+        def sizeof(value):
+            measured.append(value)
+            return len(value)
+        lru = LRUCache(sizeof=sizeof)
+        lru['a'] = 'xxx'
+        lru['b'] = 'yy'
+        lru.pop('b')
+        self.assertEqual(measured, [])
+        self.assertEqual(lru.size, 3)
+        self.assertEqual(lru.size, 3)
+        self.assertEqual(measured, ['xxx'])
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_size=6, sizeof=len)
+        lru['a'] = 'xx'
+        lru['b'] = 'xx'
+        lru['c'] = 'xx'
+        # reading 'a' makes 'b' the least recently used
+        lru.get('a')
+        lru['d'] = 'xx'
+        self.assertEqual(sorted(lru), ['a', 'c', 'd'])
+        self.assertEqual(lru.size, 6)
+        self.assertEqual(lru.evictions, 1)
+        lru['e'] = 'xxxx'
+        self.assertEqual(sorted(lru), ['d', 'e'])
+
+    def test_oversized_values_are_not_stored(self):
+        lru = LRUCache(max_size=4, sizeof=len)
+        lru['a'] = 'xx'
+        lru['b'] = 'xxxxx'
+        self.assertEqual(sorted(lru), ['a'])
+
+    def test_approximate_size(self):
+        row = (1, u'title', 'slug')
+        small = approximate_size([[row] * 10])
+        large = approximate_size([[row] * 100] * 10)
+        self.failUnless(large > small * 50)
+        self.failUnless(approximate_size({'a': 'x' * 1000}) > 1000)
@@ -0,0 +1,704 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the cache tiers johnny can stack over its cache backend."""
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+from mock import patch
+
+from johnny import settings as johnny_settings
+from johnny import tiers
+from johnny.backends import locmem
+from johnny.cache import KeyGen, KeyHandler
+from johnny.shm import SEQ, SharedTable, key_digest
+
+# put tests in here to be included in the testing suite
+__all__ = ['LocalResultCacheTest', 'SharedTableTest', 'SharedResultCacheTest',
+           'SharedGenerationCacheTest', 'ReplicatedGenerationsTest',
+           'KeyRouterTest', 'CircuitBreakerTest']
+
+
+class AddingCache(LocMemCache):
+    """A LocMemCache with ``get_or_add_many``."""
+
+    def get_or_add_many(self, data, timeout=None):
+        for key, value in data.iteritems():
+            self.add(key, value, timeout)
+        return self.get_many(list(data))
+
+
+class TierTestCase(TestCase):
+    def setUp(self):
+        self.backend = LocMemCache('tiers', {})
+        self.backend.clear()
+        self.keygen = KeyGen('jc')
+        self.keyhandler = KeyHandler(self.backend, KeyGen, 'jc')
+
+    def result_key(self, table='table', sql='SELECT 1'):
+        generation = self.keyhandler.get_generation(table)
+        return self.keyhandler.sql_key(generation, sql, (), (), 'multi')
+
+
+class LocalResultCacheTest(TierTestCase):
+    def setUp(self):
+        super(LocalResultCacheTest, self).setUp()
+        self.tier = tiers.LocalResultCache(self.backend,
+                                           self.keygen.is_query_key, 10000)
+
+    def test_is_query_key(self):
+        self.failUnless(self.keygen.is_query_key(self.result_key()))
+        self.failIf(self.keygen.is_query_key(
+            self.keygen.gen_table_key('app_query_log')))
+
+    def test_results_are_kept_in_process(self):
+        key = self.result_key()
+        self.tier.set(key, [[(1, 'a')]])
+        self.assertEqual(self.backend.get(key), [[(1, 'a')]])
+        with patch.object(self.backend, 'get') as get:
+            self.assertEqual(self.tier.get(key), [[(1, 'a')]])
+            self.failIf(get.called)
+        self.assertEqual(self.tier.stats()['l1_hits'], 1)
+
+    def test_backend_hits_are_kept(self):
+        key = self.result_key()
+        self.backend.set(key, 'rows')
+        self.assertEqual(self.tier.get_many([key]), {key: 'rows'})
+        self.assertEqual(self.tier.get(key), 'rows')
+        self.assertIsNone(self.tier.get(self.result_key(sql='SELECT 2')))
+        stats = self.tier.stats()
+        self.assertEqual((stats['l1_hits'], stats['l2_hits'], stats['misses']),
+                         (1, 1, 1))
+        self.assertEqual(stats['l1_ratio'], 1 / 3.0)
+
+    def test_generations_pass_through(self):
+        key = self.keygen.gen_table_key('table')
+        self.tier.set(key, 'gen1')
+        self.backend.set(key, 'gen2')
+        self.assertEqual(self.tier.get(key), 'gen2')
+        self.assertEqual(self.tier.get_many([key]), {key: 'gen2'})
+        self.assertEqual(len(self.tier.lru), 0)
+
+    def test_delete(self):
+        key = self.result_key()
+        self.tier.set(key, 'rows')
+        self.tier.delete(key)
+        self.assertIsNone(self.tier.get(key))
+
+    def test_stacked_by_settings(self):
+        old = johnny_settings.PROCESS_CACHE_SIZE
+        johnny_settings.PROCESS_CACHE_SIZE = 1000
+        try:
+            from johnny.transaction import TransactionManager
+            manager = TransactionManager(self.backend, KeyGen)
+            self.failUnless(isinstance(manager.cache_backend,
+                                       tiers.LocalResultCache))
+            self.failUnless('LocalResultCache' in manager.cache_stats())
+        finally:
+            johnny_settings.PROCESS_CACHE_SIZE = old
+
+
+class SharedTableTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'table')
+        # a single bucket of four 256 byte slots
+        self.table = SharedTable(self.path, 1024, 256, 4)
+
+    def tearDown(self):
+        self.table.close()
+        shutil.rmtree(self.dir)
+
+    def test_set_get_delete(self):
+        self.assertIsNone(self.table.get('a'))
+        self.failUnless(self.table.set('a', 'value'))
+        self.assertEqual(self.table.get('a'), 'value')
+        self.failUnless(self.table.set(u'a', 'other'))
+        self.assertEqual(self.table.get('a'), 'other')
+        self.table.delete('a')
+        self.assertIsNone(self.table.get('a'))
+
+    def test_private_file(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+    def test_refuses_files_others_can_use(self):
+        os.chmod(self.path, 0644)
+        self.assertRaises(OSError, SharedTable, self.path)
+        link = os.path.join(self.dir, 'link')
+        os.symlink(self.path, link)
+        os.chmod(self.path, 0600)
+        self.assertRaises(OSError, SharedTable, link)
+
+    def test_shared_between_mappings(self):
+        other = SharedTable(self.path, 64 * 1024, 8192)
+        try:
+            # the layout is read from the existing file
+            self.assertEqual((other.slot_size, other.slots), (256, 4))
+            self.table.set('a', 'value')
+            self.assertEqual(other.get('a'), 'value')
+        finally:
+            other.close()
+
+    def test_shared_between_processes(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                SharedTable(self.path).set('a', 'from child')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.table.get('a'), 'from child')
+
+    def test_oldest_is_evicted(self):
+        for key in 'abcd':
+            self.table.set(key, key)
+        self.table.set('a', 'a')
+        self.table.set('e', 'e')
+        self.assertIsNone(self.table.get('b'))
+        for key in 'acde':
+            self.assertEqual(self.table.get(key), key)
+
+    def test_too_large(self):
+        self.failIf(self.table.set('a', 'x' * 256))
+        self.assertIsNone(self.table.get('a'))
+        self.failUnless(self.table.set('a', 'x' * self.table.max_value_size))
+
+    def test_torn_write_is_a_miss(self):
+        self.table.set('a', 'value')
+        offset = self.table._choose(key_digest('a'))
+        seq = SEQ.unpack_from(self.table.map, offset)[0]
+        SEQ.pack_into(self.table.map, offset, seq + 1)
+        self.assertIsNone(self.table.get('a'))
+        # the next write repairs the slot
+        self.failUnless(self.table.set('a', 'new'))
+        self.assertEqual(self.table.get('a'), 'new')
+
+
+class SharedResultCacheTest(TierTestCase):
+    def setUp(self):
+        super(SharedResultCacheTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'results')
+        self.table = SharedTable(self.path, 64 * 1024, 1024)
+        self.tier = tiers.SharedResultCache(self.backend,
+                                            self.keygen.is_query_key,
+                                            self.table)
+
+    def tearDown(self):
+        self.table.close()
+        shutil.rmtree(self.dir)
+
+    def test_results_are_shared(self):
+        key = self.result_key()
+        self.tier.set(key, [[(1, 'a')]])
+        other = tiers.SharedResultCache(LocMemCache('other', {}),
+                                        self.keygen.is_query_key,
+                                        SharedTable(self.path))
+        try:
+            self.assertEqual(other.get(key), [[(1, 'a')]])
+            self.assertEqual(other.get_many([key]), {key: [[(1, 'a')]]})
+            self.assertEqual(other.stats()['hits'], 2)
+        finally:
+            other.table.close()
+
+    def test_backend_hits_are_kept(self):
+        key = self.result_key()
+        self.backend.set(key, 'rows')
+        self.assertEqual(self.tier.get(key), 'rows')
+        self.failIf(self.table.get(key) is None)
+        self.assertEqual(self.tier.get(key), 'rows')
+        self.assertIsNone(self.tier.get(self.result_key(sql='SELECT 2')))
+        stats = self.tier.stats()
+        self.assertEqual((stats['hits'], stats['backend_hits'],
+                          stats['misses']), (1, 1, 1))
+
+    def test_large_results_stay_in_backend(self):
+        key = self.result_key()
+        self.tier.set(key, 'x' * 2048)
+        self.assertIsNone(self.table.get(key))
+        self.assertEqual(self.tier.get(key), 'x' * 2048)
+
+    def test_generations_pass_through(self):
+        key = self.keygen.gen_table_key('table')
+        self.tier.set(key, 'gen')
+        self.assertIsNone(self.table.get(key))
+
+    def test_delete(self):
+        key = self.result_key()
+        self.tier.set(key, 'rows')
+        self.tier.delete(key)
+        self.assertIsNone(self.table.get(key))
+        self.assertIsNone(self.tier.get(key))
+
+    def test_stacked_by_settings(self):
+        old = johnny_settings.SHARED_CACHE_PATH
+        johnny_settings.SHARED_CACHE_PATH = self.path
+        try:
+            from johnny.transaction import TransactionManager
+            manager = TransactionManager(self.backend, KeyGen)
+            self.failUnless(isinstance(manager.cache_backend,
+                                       tiers.SharedResultCache))
+            manager.cache_backend.table.close()
+        finally:
+            johnny_settings.SHARED_CACHE_PATH = old
+
+
+class SharedGenerationCacheTest(TierTestCase):
+    def setUp(self):
+        super(SharedGenerationCacheTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'generations')
+        self.tier = self.make_tier(self.backend)
+        self.table = self.tier.table
+        self.key = self.keygen.gen_table_key('table')
+
+    def tearDown(self):
+        self.tier.agent.stop()
+        self.table.close()
+        shutil.rmtree(self.dir)
+
+    def make_tier(self, backend):
+        tier = tiers.SharedGenerationCache(
+            backend, self.keygen.is_query_key,
+            SharedTable(self.path, 64 * 1024, 128), 'jc_generation_epoch',
+            interval=0.01)
+        # the agent is started by hand in the tests that need it
+        tier.agent_pid = os.getpid()
+        return tier
+
+    def test_generations_are_shared(self):
+        self.backend.set(self.key, 'gen1')
+        self.assertEqual(self.tier.get(self.key), 'gen1')
+        other = self.make_tier(LocMemCache('other', {}))
+        try:
+            self.assertEqual(other.get(self.key), 'gen1')
+            self.assertEqual(other.get_many([self.key]), {self.key: 'gen1'})
+            self.assertEqual(other.stats()['hits'], 2)
+        finally:
+            other.table.close()
+
+    def test_results_pass_through(self):
+        key = self.result_key()
+        self.tier.set(key, 'rows')
+        self.assertIsNone(self.table.get(key))
+        self.assertEqual(self.tier.get(key), 'rows')
+
+    def test_local_writes_go_through_both(self):
+        other_key = self.keygen.gen_table_key('other')
+        self.backend.set(self.key, 'gen1')
+        self.backend.set(other_key, 'gen1')
+        self.tier.get_many([self.key, other_key])
+        version = self.table.version
+        self.tier.set(self.key, 'gen2')
+        self.assertEqual(self.backend.get(self.key), 'gen2')
+        # only the written entry changes
+        self.assertEqual(self.table.version, version)
+        self.failIf(self.backend.get('jc_generation_epoch') is None)
+        with patch.object(self.backend, 'get') as get:
+            self.assertEqual(self.tier.get(self.key), 'gen2')
+            self.assertEqual(self.tier.get(other_key), 'gen1')
+            self.failIf(get.called)
+
+    def test_local_writes_keep_the_table(self):
+        self.tier.set(self.keygen.gen_table_key('other'), 'gen0')
+        self.tier.agent.poll()
+        self.backend.set(self.key, 'gen1')
+        self.tier.get(self.key)
+        version = self.table.version
+        self.tier.set(self.keygen.gen_table_key('other'), 'gen1')
+        self.tier.set(self.keygen.gen_table_key('other'), 'gen2')
+        self.failIf(self.tier.agent.poll())
+        self.assertEqual(self.table.version, version)
+        # a write from another host
+        self.backend.incr('jc_generation_epoch')
+        self.failUnless(self.tier.agent.poll())
+        self.assertEqual(self.table.version, version + 1)
+
+    def test_reads_racing_writes_are_dropped(self):
+        self.backend.set(self.key, 'gen1')
+        get = self.backend.get
+        def racing_get(key, default=None):
+            value = get(key, default)
+            self.tier.set(self.key, 'gen2')
+            return value
+        with patch.object(self.backend, 'get', racing_get):
+            self.assertEqual(self.tier.get(self.key), 'gen1')
+        self.assertEqual(self.tier.get(self.key), 'gen2')
+
+    def test_stale_entries_are_dropped(self):
+        self.backend.set(self.key, 'gen1')
+        self.tier.get(self.key)
+        # an invalidation from another host
+        self.backend.set(self.key, 'gen2')
+        self.backend.set('jc_generation_epoch', 'epoch')
+        self.assertEqual(self.tier.get(self.key), 'gen1')
+        self.failUnless(self.tier.agent.poll())
+        self.failIf(self.tier.agent.poll())
+        self.assertEqual(self.tier.get(self.key), 'gen2')
+
+    def test_private_lock_file(self):
+        lock = self.path + '.lock'
+        self.assertEqual(os.stat(lock).st_mode & 0777, 0600)
+        os.chmod(lock, 0666)
+        self.assertRaises(OSError, tiers.GenerationAgent, self.tier, 1)
+
+    def test_agent(self):
+        self.tier.agent_pid = None
+        self.tier.get(self.key)
+        self.failUnless(self.tier.agent.isAlive())
+        other = self.make_tier(self.backend)
+        other.agent_pid = None
+        other.get(self.key)
+        def wait_for(condition):
+            for i in range(100):
+                if condition():
+                    break
+                time.sleep(0.01)
+        try:
+            wait_for(lambda: self.tier.agent.epoch is not tiers.MISSING)
+            version = self.table.version
+            self.backend.set('jc_generation_epoch', 'epoch')
+            wait_for(lambda: self.table.version != version)
+            time.sleep(0.05)
+            # only one of the agents polls
+            self.assertEqual(self.table.version, version + 1)
+            self.assertEqual(other.agent.epoch, tiers.MISSING)
+        finally:
+            other.agent.stop()
+            other.table.close()
+
+    def test_stacked_by_settings(self):
+        old = johnny_settings.SHARED_GENERATION_PATH
+        johnny_settings.SHARED_GENERATION_PATH = self.path
+        try:
+            from johnny.transaction import TransactionManager
+            manager = TransactionManager(self.backend, KeyGen)
+            tier = manager.cache_backend
+            self.failUnless(isinstance(tier, tiers.SharedGenerationCache))
+            tier.agent_pid = os.getpid()
+            generation = KeyHandler(manager, KeyGen, 'jc').get_generation('t')
+            self.assertEqual(tier.table.get(self.keygen.gen_table_key('t'))[8:],
+                             generation)
+            tier.table.close()
+        finally:
+            johnny_settings.SHARED_GENERATION_PATH = old
+
+
+class ReplicatedGenerationsTest(TierTestCase):
+    def setUp(self):
+        super(ReplicatedGenerationsTest, self).setUp()
+        self.key = self.keygen.gen_table_key('hot')
+        self.tier = tiers.ReplicatedGenerations(self.backend, {self.key: 3})
+
+    def test_writes_go_to_every_replica(self):
+        with patch.object(self.backend, 'set_many',
+                          wraps=self.backend.set_many) as set_many:
+            self.tier.set(self.key, 'gen')
+            self.assertEqual(set_many.call_count, 1)
+        self.assertEqual(self.tier.replica_keys(self.key),
+                         [self.key, self.key + '.1', self.key + '.2'])
+        for key in self.tier.replica_keys(self.key):
+            self.assertEqual(self.backend.get(key), 'gen')
+        self.tier.delete(self.key)
+        for key in self.tier.replica_keys(self.key):
+            self.assertIsNone(self.backend.get(key))
+
+    def test_reads_are_spread(self):
+        self.tier.set_many({self.key: 'gen', 'other': 'value'})
+        self.assertIsNone(self.backend.get('other.1'))
+        read = set()
+        original = self.backend.get_many
+        def get_many(keys):
+            read.update(keys)
+            return original(keys)
+        with patch.object(self.backend, 'get_many', get_many):
+            for i in range(50):
+                self.assertEqual(self.tier.get_many([self.key, 'other']),
+                                 {self.key: 'gen', 'other': 'value'})
+        self.assertEqual(read, set(self.tier.replica_keys(self.key) +
+                                   ['other']))
+
+    def test_missing_replica_reads_as_missing(self):
+        self.tier.set(self.key, 'gen')
+        self.backend.delete(self.key + '.1')
+        results = set([self.tier.get(self.key) for i in range(50)])
+        self.assertEqual(results, set(['gen', None]))
+
+    def test_get_or_add_many(self):
+        self.failIf(hasattr(self.tier, 'get_or_add_many'))
+        self.tier.backend = AddingCache('tiers', {})
+        self.backend.set('other', 'existing')
+        self.assertEqual(self.tier.get_or_add_many({self.key: 'gen',
+                                                    'other': 'new'}),
+                         {self.key: 'gen', 'other': 'existing'})
+        for key in self.tier.replica_keys(self.key):
+            self.assertEqual(self.backend.get(key), 'gen')
+
+    def test_invalidation(self):
+        from johnny.transaction import TransactionManager
+        old = johnny_settings.GENERATION_REPLICAS
+        johnny_settings.GENERATION_REPLICAS = {'hot': 3}
+        try:
+            # generations are stored with a timeout of 0, which is only
+            # "forever" with johnny's backends
+            self.backend = self.tier.backend = locmem.LocMemCache('hot', {})
+            manager = TransactionManager(self.backend, KeyGen)
+            self.failUnless(isinstance(manager.cache_backend,
+                                       tiers.ReplicatedGenerations))
+            keyhandler = KeyHandler(manager, KeyGen, 'jc')
+            generation = keyhandler.get_generation('hot')
+            for key in self.tier.replica_keys(self.key):
+                self.assertEqual(self.backend.get(key), generation)
+            new = keyhandler.invalidate_table('hot')
+            for key in self.tier.replica_keys(self.key):
+                self.assertEqual(self.backend.get(key), new)
+        finally:
+            johnny_settings.GENERATION_REPLICAS = old
+
+
+class KeyRouterTest(TierTestCase):
+    def setUp(self):
+        super(KeyRouterTest, self).setUp()
+        self.results = LocMemCache('results', {})
+        self.results.clear()
+        self.tier = tiers.KeyRouter(self.backend, self.results,
+                                    self.keygen.is_query_key)
+        self.generation_key = self.keygen.gen_table_key('table')
+
+    def test_routing(self):
+        result_key = self.result_key()
+        self.tier.set(self.generation_key, 'gen')
+        self.tier.set(result_key, 'rows')
+        self.assertEqual(self.backend.get(self.generation_key), 'gen')
+        self.assertIsNone(self.backend.get(result_key))
+        self.assertEqual(self.results.get(result_key), 'rows')
+        self.assertIsNone(self.results.get(self.generation_key))
+        self.assertEqual(self.tier.get(result_key), 'rows')
+        self.assertEqual(self.tier.get_many([self.generation_key, result_key]),
+                         {self.generation_key: 'gen', result_key: 'rows'})
+        self.tier.delete_many([self.generation_key, result_key])
+        self.assertEqual(self.tier.get_many([self.generation_key, result_key]),
+                         {})
+
+    def test_commit(self):
+        from johnny.transaction import TransactionCache
+        result_key = self.result_key()
+        tx_cache = TransactionCache(self.tier)
+        tx_cache.timeout = 1000
+        tx_cache.set(self.generation_key, 'gen')
+        tx_cache.set(result_key, 'rows')
+        tx_cache.commit()
+        self.assertEqual(self.backend.get(self.generation_key), 'gen')
+        self.assertEqual(self.results.get(result_key), 'rows')
+
+    def test_stacked_by_settings(self):
+        from johnny.transaction import TransactionManager
+        old = johnny_settings.RESULT_CACHE
+        johnny_settings.RESULT_CACHE = 'johnny.backends.locmem.LocMemCache'
+        try:
+            manager = TransactionManager(self.backend, KeyGen)
+            self.failUnless(isinstance(manager.cache_backend, tiers.KeyRouter))
+            self.failUnless(manager.cache_backend.backend is self.backend)
+        finally:
+            johnny_settings.RESULT_CACHE = old
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SlowCache(object):
+    """Wraps a cache, adding ``delay`` seconds to every call (on ``clock``
+    if given, otherwise for real) and raising ``error`` if it's set."""
+
+    def __init__(self, cache, clock=None):
+        self.cache = cache
+        self.clock = clock
+        self.delay = 0
+        self.error = None
+        self.calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.cache, name)
+        def call(*args, **kwargs):
+            self.calls += 1
+            if self.clock is not None:
+                self.clock.now += self.delay
+            elif self.delay:
+                time.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            return method(*args, **kwargs)
+        return call
+
+
+class CircuitBreakerTest(TierTestCase):
+    def setUp(self):
+        super(CircuitBreakerTest, self).setUp()
+        self.backend = AddingCache('tiers', {})
+        self.clock = Clock()
+        self.slow = SlowCache(self.backend, self.clock)
+        self.tier = self.make_breaker(self.slow)
+        self.key = self.keygen.gen_table_key('table')
+
+    def make_breaker(self, backend, clock=None):
+        return tiers.CircuitBreaker(backend, self.keygen.is_query_key,
+                                    window=10, min_calls=4, failure_ratio=0.5,
+                                    latency_budget=0.01, cooldown=5,
+                                    clock=clock or self.clock)
+
+    def trip(self):
+        self.slow.delay = 0.1
+        for i in range(4):
+            self.tier.get(self.key)
+        self.slow.delay = 0
+        self.failUnless(self.tier.is_open())
+
+    def test_trips_on_latency(self):
+        self.tier.set(self.key, 'gen')
+        self.slow.delay = 0.1
+        # slow calls still return what the backend had
+        self.assertEqual(self.tier.get(self.key), 'gen')
+        self.slow.delay = 0.001
+        self.tier.get(self.key)
+        self.tier.get(self.key)
+        self.slow.delay = 0.1
+        self.tier.get(self.key)
+        self.failIf(self.tier.is_open())
+        # half of the calls in the window are now too slow
+        self.tier.get(self.key)
+        self.failUnless(self.tier.is_open())
+        self.assertEqual(self.tier.stats()['trips'], 1)
+
+    def test_trips_on_real_latency(self):
+        slow = SlowCache(self.backend)
+        tier = self.make_breaker(slow, time.time)
+        slow.delay = 0.02
+        for i in range(4):
+            tier.get(self.key)
+        self.failUnless(tier.is_open())
+
+    def test_trips_on_errors(self):
+        self.slow.error = ValueError()
+        for i in range(4):
+            self.assertEqual(self.tier.get(self.key, 'default'), 'default')
+        self.assertEqual(self.tier.get_many([self.key]), {})
+        self.failUnless(self.tier.is_open())
+
+    def test_failures_leave_the_window(self):
+        self.slow.delay = 0.1
+        for i in range(2):
+            self.tier.get(self.key)
+        self.clock.now += 60
+        self.slow.delay = 0
+        for i in range(2):
+            self.tier.get(self.key)
+        self.failIf(self.tier.is_open())
+
+    def test_open_breaker_skips_the_backend(self):
+        result_key = self.result_key()
+        self.backend.set(self.key, 'gen')
+        self.trip()
+        calls = self.slow.calls
+        self.assertIsNone(self.tier.get(self.key))
+        self.tier.set(result_key, 'rows')
+        self.assertEqual(self.tier.get_many([self.key]), {})
+        self.assertEqual(self.slow.calls, calls)
+        self.assertIsNone(self.backend.get(result_key))
+        self.assertEqual(self.tier.stats()['bypassed'], 3)
+
+    def test_open_breaker_writes_generations(self):
+        self.backend.set(self.key, 'gen')
+        self.trip()
+        self.tier.set_many({self.key: 'new', self.result_key(): 'rows'})
+        self.assertEqual(self.backend.get(self.key), 'new')
+        self.assertIsNone(self.backend.get(self.result_key()))
+        self.assertEqual(self.tier.get_or_add_many({'other': 'gen'}),
+                         {'other': 'gen'})
+        self.assertEqual(self.backend.get('other'), 'gen')
+        self.assertEqual(self.tier.stats()['pending'], 0)
+        self.failUnless(self.tier.is_open())
+
+    def test_recovery_replays_invalidations(self):
+        self.backend.set(self.key, 'gen')
+        self.trip()
+        self.slow.error = ValueError()
+        self.tier.set(self.key, 'new')
+        self.assertEqual(self.tier.stats()['pending'], 1)
+        self.slow.error = None
+        self.clock.now += 5
+        self.failIf(self.tier.is_open())
+        # the probe succeeds, closing the breaker
+        self.assertEqual(self.tier.get('probe', 'default'), 'default')
+        self.assertEqual(self.tier.state, tiers.CircuitBreaker.CLOSED)
+        # a new generation, as results may have been stored under 'new'
+        self.failIf(self.backend.get(self.key) in ('gen', 'new', None))
+        self.assertEqual(self.tier.stats()['pending'], 0)
+
+    def test_created_generations_are_not_replayed(self):
+        self.slow.error = ValueError()
+        self.assertIsNone(self.tier.get(self.key))
+        # the generation johnny creates when it can't read one
+        self.tier.set(self.key, 'created')
+        self.assertEqual(self.tier.get_or_add_many({'other': 'created'}),
+                         {'other': 'created'})
+        self.assertEqual(self.tier.stats()['pending'], 0)
+        # later writes do invalidate
+        self.tier.set(self.key, 'new')
+        self.assertEqual(self.tier.stats()['pending'], 1)
+
+    def test_replays_a_failure_below_the_threshold(self):
+        self.backend.set(self.key, 'gen')
+        self.slow.error = ValueError()
+        self.tier.set(self.key, 'new')
+        self.failIf(self.tier.is_open())
+        self.assertEqual(self.tier.stats()['pending'], 1)
+        self.slow.error = None
+        self.tier.get('other')
+        self.failIf(self.backend.get(self.key) in ('gen', 'new', None))
+        self.assertEqual(self.tier.stats()['pending'], 0)
+
+    def test_get_or_add_many(self):
+        self.backend.set(self.key, 'existing')
+        self.assertEqual(self.tier.get_or_add_many({self.key: 'new',
+                                                    'other': 'new'}),
+                         {self.key: 'existing', 'other': 'new'})
+        tier = self.make_breaker(LocMemCache('tiers', {}))
+        self.failIf(hasattr(tier, 'get_or_add_many'))
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.clock.now += 5
+        self.slow.error = ValueError()
+        self.tier.get(self.key)
+        self.failUnless(self.tier.is_open())
+        self.slow.error = None
+        self.tier.get(self.key)
+        self.assertEqual(self.slow.calls, 5)
+        self.clock.now += 5
+        self.tier.get(self.key)
+        self.failIf(self.tier.is_open())
+        self.assertEqual(self.tier.stats()['trips'], 1)
+
+    def test_stacked_by_settings(self):
+        from johnny.transaction import TransactionManager
+        old = johnny_settings.CIRCUIT_BREAKER
+        johnny_settings.CIRCUIT_BREAKER = {'min_calls': 1}
+        try:
+            manager = TransactionManager(self.backend, KeyGen)
+            self.failUnless(isinstance(manager.cache_backend,
+                                       tiers.CircuitBreaker))
+            self.failIf(manager.is_bypassed())
+            manager.cache_backend._open(time.time())
+            self.failUnless(manager.is_bypassed())
+        finally:
+            johnny_settings.CIRCUIT_BREAKER = old
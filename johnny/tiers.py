@@ -0,0 +1,894 @@
+"""
+Cache tiers that can be stacked between johnny's ``TransactionManager`` and
+the django cache backend it uses.  Each tier wraps the next one down and
+presents the same ``get``/``set`` style API as a django cache.
+"""
+
+import fcntl
+import os
+import random
+import struct
+import threading
+import time
+from collections import deque
+from uuid import uuid4
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from johnny import settings
+from johnny.datastructures import LRUCache
+from johnny.shm import open_private
+
+MISSING = object()
+EPOCH = struct.Struct('<Q')
+
+
+def backend_has(name):
+    """Makes the decorated method of a tier an attribute only where the
+    backend it wraps has ``name``, so that johnny can tell whether the
+    whole stack supports it."""
+    def decorator(method):
+        def get(self):
+            if getattr(self.backend, name, None) is None:
+                raise AttributeError(name)
+            return method.__get__(self, type(self))
+        return property(get, doc=method.__doc__)
+    return decorator
+
+
+class CacheTier(object):
+    """Base class for cache tiers.  Everything is passed straight through to
+    the wrapped ``backend``;  subclasses override what they need."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get(self, key, default=None):
+        return self.backend.get(key, default)
+
+    def get_many(self, keys):
+        return self.backend.get_many(keys)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        self.backend.set_many(data, timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def delete_many(self, keys):
+        self.backend.delete_many(keys)
+
+    def stats(self):
+        return {}
+
+
+class KeyRouter(CacheTier):
+    """
+    Keeps query results in the ``results`` cache and everything else, which
+    is to say the table generations, in ``backend``, so that results being
+    evicted can't push generations out with them.
+    """
+
+    def __init__(self, backend, results, is_result_key):
+        super(KeyRouter, self).__init__(backend)
+        self.results = results
+        self.is_result_key = is_result_key
+
+    def _route(self, key):
+        if self.is_result_key(key):
+            return self.results
+        return self.backend
+
+    def _split(self, keys):
+        results, others = [], []
+        for key in keys:
+            if self.is_result_key(key):
+                results.append(key)
+            else:
+                others.append(key)
+        return results, others
+
+    def get(self, key, default=None):
+        return self._route(key).get(key, default)
+
+    def get_many(self, keys):
+        results, others = self._split(keys)
+        found = {}
+        if others:
+            found.update(self.backend.get_many(others))
+        if results:
+            found.update(self.results.get_many(results))
+        return found
+
+    def set(self, key, value, timeout=None):
+        self._route(key).set(key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        results, others = self._split(data)
+        if others:
+            self.backend.set_many(dict([(k, data[k]) for k in others]),
+                                  timeout)
+        if results:
+            self.results.set_many(dict([(k, data[k]) for k in results]),
+                                  timeout)
+
+    def delete(self, key):
+        self._route(key).delete(key)
+
+    def delete_many(self, keys):
+        results, others = self._split(keys)
+        if others:
+            self.backend.delete_many(others)
+        if results:
+            self.results.delete_many(results)
+
+    def clear(self):
+        self.backend.clear()
+        self.results.clear()
+
+
+class CircuitBreaker(CacheTier):
+    """
+    Stops using ``backend`` while it's failing or slow, so that a degraded
+    cache server doesn't hold up every query on its way to the database.
+
+    Every call to the backend is timed, and those that raise or take longer
+    than ``latency_budget`` seconds count as failures.  Once at least
+    ``min_calls`` calls were made in the last ``window`` seconds and
+    ``failure_ratio`` of them failed, the breaker opens.  While it's open
+    reads miss and results aren't stored.  Generations (which is how tables
+    are invalidated) are still written, since other processes may be using
+    the backend all along.  ``is_open`` tells johnny to bypass the query
+    cache altogether in the meantime.
+
+    After ``cooldown`` seconds one call is let through to probe the backend
+    (the breaker is half-open).  If it succeeds the breaker closes again;
+    if not it opens for another ``cooldown``.
+
+    Errors raised by the backend are not passed on.  A failed read misses,
+    and the key of a generation write that raised is kept.  Kept keys are
+    written after the next successful call, with generations minted by
+    ``new_generation`` rather than the values that failed:  results may
+    have been cached under those since, by other processes.  The first
+    write of a generation that was just read as missing creates it rather
+    than invalidating the table, so it isn't kept if it fails.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, backend, is_result_key, window=10, min_calls=20,
+                 failure_ratio=0.5, latency_budget=0.05, cooldown=5,
+                 clock=time.time, new_generation=None):
+        super(CircuitBreaker, self).__init__(backend)
+        self.is_result_key = is_result_key
+        self.new_generation = new_generation or (lambda: str(uuid4()))
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        # (time, failed) for each call in the window, oldest first
+        self.calls = deque()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.pending = set()
+        self.pending_timeout = None
+        # generation keys read as missing since they were last written
+        self.missing = set()
+        self.trips = self.bypassed = 0
+
+    def is_open(self):
+        """Returns True while the backend shouldn't be used."""
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.OPEN and \
+                self.clock() - self.opened_at >= self.cooldown:
+            return False
+        return True
+
+    def _acquire(self):
+        """Returns True if a call may go to the backend, and whether it's
+        the probe of a half-open breaker."""
+        self.lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True, False
+            if not self.probing and \
+                    self.clock() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self.probing = True
+                return True, True
+            self.bypassed += 1
+            return False, False
+        finally:
+            self.lock.release()
+
+    def _record(self, now, failed, probe):
+        self.lock.acquire()
+        try:
+            if probe:
+                self.probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    self._close()
+                return
+            if self.state != self.CLOSED:
+                return
+            calls = self.calls
+            calls.append((now, failed))
+            self.failures += failed
+            while calls and calls[0][0] < now - self.window:
+                self.failures -= calls.popleft()[1]
+            if len(calls) >= self.min_calls and \
+                    self.failures >= self.failure_ratio * len(calls):
+                self._open(now)
+        finally:
+            self.lock.release()
+
+    def _open(self, now):
+        if self.state == self.CLOSED:
+            self.trips += 1
+        self.state = self.OPEN
+        self.opened_at = now
+        self.calls.clear()
+        self.failures = 0
+
+    def _close(self):
+        self.state = self.CLOSED
+
+    def _keep(self, keys, timeout):
+        if keys:
+            self.lock.acquire()
+            try:
+                self.pending.update(keys)
+                self.pending_timeout = timeout
+            finally:
+                self.lock.release()
+
+    def _unread(self, keys):
+        """Remembers the generation ``keys`` that were read as missing."""
+        keys = [k for k in keys if not self.is_result_key(k)]
+        if keys:
+            self.lock.acquire()
+            try:
+                self.missing.update(keys)
+            finally:
+                self.lock.release()
+
+    def _invalidated(self, keys):
+        """Returns the generation ``keys`` written that invalidate their
+        tables, rather than create a generation that was read as missing."""
+        self.lock.acquire()
+        try:
+            invalidated = [k for k in keys if k not in self.missing]
+            self.missing.difference_update(keys)
+        finally:
+            self.lock.release()
+        return invalidated
+
+    def _flush(self):
+        """Writes new generations for the kept keys."""
+        self.lock.acquire()
+        try:
+            keys, self.pending = self.pending, set()
+            timeout = self.pending_timeout
+        finally:
+            self.lock.release()
+        if not keys:
+            return
+        data = dict([(k, self.new_generation()) for k in keys])
+        ok, result = self._timed(False, 'set_many', data, timeout)
+        if not ok:
+            self._keep(keys, timeout)
+
+    def _call(self, method, *args):
+        """Calls ``method`` of the backend if the breaker allows it.  Returns
+        whether it was called successfully, and its result."""
+        allowed, probe = self._acquire()
+        if not allowed:
+            return False, None
+        return self._timed(probe, method, *args)
+
+    def _timed(self, probe, method, *args):
+        """Calls ``method`` of the backend, whatever the state of the
+        breaker, and records how that went."""
+        start = self.clock()
+        try:
+            result = getattr(self.backend, method)(*args)
+        except Exception:
+            self._record(self.clock(), True, probe)
+            return False, None
+        now = self.clock()
+        self._record(now, now - start > self.latency_budget, probe)
+        if self.pending:
+            self._flush()
+        return True, result
+
+    def get(self, key, default=None):
+        ok, value = self._call('get', key, MISSING)
+        if ok and value is not MISSING:
+            return value
+        self._unread([key])
+        return default
+
+    def get_many(self, keys):
+        ok, values = self._call('get_many', keys)
+        if not ok:
+            values = {}
+        self._unread([k for k in keys if k not in values])
+        return values
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=None):
+        generations = dict([(k, v) for k, v in data.iteritems()
+                            if not self.is_result_key(k)])
+        invalidated = self._invalidated(generations)
+        if len(generations) < len(data):
+            allowed, probe = self._acquire()
+            if allowed:
+                ok, result = self._timed(probe, 'set_many', data, timeout)
+                if not ok:
+                    self._keep(invalidated, timeout)
+                return
+        if generations:
+            ok, result = self._timed(False, 'set_many', generations,
+                                     timeout)
+            if not ok:
+                self._keep(invalidated, timeout)
+
+    def delete(self, key):
+        self._call('delete', key)
+
+    def delete_many(self, keys):
+        self._call('delete_many', keys)
+
+    @backend_has('get_or_add_many')
+    def get_or_add_many(self, data, timeout=None):
+        # only ever creates generations, so nothing is kept if it fails
+        self._invalidated(data)
+        ok, results = self._timed(False, 'get_or_add_many', data, timeout)
+        if ok:
+            return results
+        return data
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'trips': self.trips,
+            'bypassed': self.bypassed,
+            'pending': len(self.pending),
+        }
+
+
+class ReplicatedGenerations(CacheTier):
+    """
+    Stores the generation keys in ``replicas``, a dict of key to number of
+    copies, under that many keys so that they hash to different cache
+    servers and their reads are spread over them.  Each read picks one of
+    the copies at random;  writes and deletes go to all of them at once.
+    The first copy is kept under the key itself.
+
+    A copy that has been evicted reads as a missing generation, so johnny
+    creates a new one, writing every copy again.
+    """
+
+    def __init__(self, backend, replicas):
+        super(ReplicatedGenerations, self).__init__(backend)
+        self.replicas = replicas
+
+    def replica_keys(self, key):
+        return [key] + ['%s.%d' % (key, i)
+                        for i in range(1, self.replicas.get(key, 1))]
+
+    def _pick(self, key):
+        count = self.replicas.get(key)
+        if count > 1:
+            i = random.randrange(count)
+            if i:
+                return '%s.%d' % (key, i)
+        return key
+
+    def _expand(self, data):
+        expanded = {}
+        for key, value in data.iteritems():
+            for replica in self.replica_keys(key):
+                expanded[replica] = value
+        return expanded
+
+    def get(self, key, default=None):
+        return self.backend.get(self._pick(key), default)
+
+    def get_many(self, keys):
+        picked = dict((self._pick(key), key) for key in keys)
+        found = self.backend.get_many(list(picked))
+        return dict((picked[key], value) for key, value in found.iteritems())
+
+    def set(self, key, value, timeout=None):
+        if key in self.replicas:
+            self.backend.set_many(self._expand({key: value}), timeout)
+        else:
+            self.backend.set(key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        self.backend.set_many(self._expand(data), timeout)
+
+    def delete(self, key):
+        self.backend.delete_many(self.replica_keys(key))
+
+    def delete_many(self, keys):
+        replicas = []
+        for key in keys:
+            replicas.extend(self.replica_keys(key))
+        self.backend.delete_many(replicas)
+
+    @backend_has('get_or_add_many')
+    def get_or_add_many(self, data, timeout=None):
+        # The copies can't be added atomically together, so replicated
+        # generations are written just as johnny does without this.
+        results, others = {}, {}
+        for key, value in data.iteritems():
+            if key in self.replicas:
+                results[key] = value
+            else:
+                others[key] = value
+        if results:
+            self.set_many(results, timeout)
+        if others:
+            results.update(self.backend.get_or_add_many(others, timeout))
+        return results
+
+
+class ResultTier(CacheTier):
+    """
+    Base class for tiers that keep copies of query results.  Result keys
+    embed the generations of their tables, so the value stored under one
+    never changes and can be kept for as long as there is room.  Generation
+    keys do change, and are always passed through to the backend.
+
+    Subclasses define where the copies are kept, with ``_lookup(key)``,
+    which returns the value kept for ``key`` or MISSING, ``_store(data)``,
+    which keeps the result keys and values in the dict ``data``, and
+    ``_discard(keys)``.
+    """
+
+    def __init__(self, backend, is_result_key):
+        super(ResultTier, self).__init__(backend)
+        self.is_result_key = is_result_key
+        self.hits = self.backend_hits = self.misses = 0
+
+    def _results(self, data):
+        return dict([(k, v) for k, v in data.iteritems()
+                     if self.is_result_key(k)])
+
+    def get(self, key, default=None):
+        if not self.is_result_key(key):
+            return self.backend.get(key, default)
+        value = self._lookup(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        value = self.backend.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.backend_hits += 1
+        self._store({key: value})
+        return value
+
+    def get_many(self, keys):
+        results = {}
+        lookup = []
+        for key in keys:
+            if self.is_result_key(key):
+                value = self._lookup(key)
+                if value is not MISSING:
+                    self.hits += 1
+                    results[key] = value
+                    continue
+            lookup.append(key)
+        if lookup:
+            found = self.backend.get_many(lookup)
+            results.update(found)
+            self._store(self._results(found))
+            for key in lookup:
+                if self.is_result_key(key):
+                    if key in found:
+                        self.backend_hits += 1
+                    else:
+                        self.misses += 1
+        return results
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout)
+        if self.is_result_key(key):
+            self._store({key: value})
+
+    def set_many(self, data, timeout=None):
+        self.backend.set_many(data, timeout)
+        self._store(self._results(data))
+
+    def delete(self, key):
+        self._discard([key])
+        self.backend.delete(key)
+
+    def delete_many(self, keys):
+        self._discard(keys)
+        self.backend.delete_many(keys)
+
+    def stats(self):
+        lookups = self.hits + self.backend_hits + self.misses
+        return {
+            'hits': self.hits,
+            'backend_hits': self.backend_hits,
+            'misses': self.misses,
+            'hit_ratio': lookups and float(self.hits) / lookups,
+        }
+
+
+class LocalResultCache(ResultTier):
+    """
+    An in-process cache of query results, shared by every thread in the
+    process, which saves both the trip to the cache backend and the
+    unpickling of the result.
+
+    ``stats`` reports how many result lookups were answered here (l1), by
+    the tiers below (l2) or not at all.
+    """
+
+    def __init__(self, backend, is_result_key, max_size):
+        super(LocalResultCache, self).__init__(backend, is_result_key)
+        self.lru = LRUCache(max_size)
+        self.lock = threading.Lock()
+
+    def _lookup(self, key):
+        self.lock.acquire()
+        try:
+            return self.lru.get(key, MISSING)
+        finally:
+            self.lock.release()
+
+    def _store(self, data):
+        self.lock.acquire()
+        try:
+            self.lru.update(data)
+        finally:
+            self.lock.release()
+
+    def _discard(self, keys):
+        self.lock.acquire()
+        try:
+            for key in keys:
+                self.lru.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        lookups = self.hits + self.backend_hits + self.misses
+        return {
+            'l1_hits': self.hits,
+            'l2_hits': self.backend_hits,
+            'misses': self.misses,
+            'l1_ratio': lookups and float(self.hits) / lookups,
+            'l2_ratio': lookups and float(self.backend_hits) / lookups,
+            'size': self.lru.size,
+            'evictions': self.lru.evictions,
+        }
+
+
+class SharedResultCache(ResultTier):
+    """
+    A cache of pickled query results shared by every process on the host
+    through a ``johnny.shm.SharedTable``, which evicts results on its own.
+    Results too large for one of its slots are only kept in the backend.
+    """
+
+    def __init__(self, backend, is_result_key, table):
+        super(SharedResultCache, self).__init__(backend, is_result_key)
+        self.table = table
+
+    def _lookup(self, key):
+        value = self.table.get(key)
+        if value is None:
+            return MISSING
+        try:
+            return pickle.loads(value)
+        except Exception:
+            return MISSING
+
+    def _store(self, data):
+        for key, value in data.iteritems():
+            self.table.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _discard(self, keys):
+        for key in keys:
+            self.table.delete(key)
+
+
+class SharedGenerationCache(CacheTier):
+    """
+    Keeps table generations in a ``johnny.shm.SharedTable`` shared by every
+    process on the host, so that a generation is fetched from the backend
+    once per host rather than once per process.
+
+    Each entry is tagged with the table's version when it was stored, and is
+    only used while that is still the table's version.  Generations written
+    on this host go to the backend and then to their entries in the table,
+    so they're seen here at once.  The table counts these writes, and a
+    generation read from the backend while one was made isn't kept, as it
+    may be older than the one written.
+
+    Writes also increment the epoch kept in the backend under
+    ``epoch_key``, marking each epoch they reach in the table.  A
+    ``GenerationAgent`` thread, one per host, watches the epoch.  When it
+    reaches one that wasn't marked here, another host has written
+    generations, so it bumps the table's version, which drops every entry.
+    Generations invalidated on other hosts are picked up within one polling
+    ``interval``.
+    """
+    # how many epochs the agent looks for marks of, before it gives up and
+    # drops every entry
+    max_marks = 64
+
+    def __init__(self, backend, is_result_key, table, epoch_key,
+                 interval=1.0, timeout=None):
+        super(SharedGenerationCache, self).__init__(backend)
+        self.is_result_key = is_result_key
+        self.table = table
+        self.epoch_key = epoch_key
+        self.timeout = timeout
+        self.agent = GenerationAgent(self, interval)
+        self.agent_pid = None
+        self.hits = self.misses = 0
+
+    def start_agent(self):
+        """Starts this process' agent thread, if it isn't running already.
+        The agent's thread doesn't survive a fork, so this is checked on
+        every read."""
+        pid = os.getpid()
+        if self.agent_pid != pid:
+            self.agent_pid = pid
+            self.agent = GenerationAgent(self, self.agent.interval)
+            self.agent.start()
+
+    def _lookup(self, key, version):
+        value = self.table.get(key)
+        if value is not None and EPOCH.unpack_from(value)[0] == version:
+            self.hits += 1
+            return value[EPOCH.size:]
+        self.misses += 1
+        return MISSING
+
+    def _store(self, data, version):
+        for key, value in data.iteritems():
+            if not isinstance(value, str) or not self.table.set(
+                    key, EPOCH.pack(version) + value, True):
+                self.table.delete(key)
+
+    def _store_read(self, data, version, writes):
+        """Stores generations read from the backend, unless generations
+        were written since ``writes`` was the table's count of writes."""
+        self._store(data, version)
+        if self.table.writes != writes:
+            for key in data:
+                self.table.delete(key)
+
+    def _generations(self, data):
+        return dict([(k, v) for k, v in data.iteritems()
+                     if not self.is_result_key(k)])
+
+    def _mark(self, epoch):
+        return '%s.%d' % (self.epoch_key, epoch)
+
+    def bump_epoch(self):
+        """Increments the epoch in the backend and marks the new one as
+        reached by a write on this host."""
+        try:
+            epoch = int(self.backend.incr(self.epoch_key))
+        except (ValueError, TypeError):
+            # there's no epoch yet, or one that isn't a count;  a random
+            # one won't be mistaken for one the agents have seen before
+            epoch = random.randrange(1, 1 << 48)
+            if not self.backend.add(self.epoch_key, epoch, self.timeout):
+                self.backend.set(self.epoch_key, epoch, self.timeout)
+        self.table.set(self._mark(epoch), '1', True)
+
+    def written_here(self, previous, epoch):
+        """Returns True if writes on this host took the epoch from
+        ``previous`` to ``epoch``, and no others."""
+        try:
+            previous, epoch = int(previous), int(epoch)
+        except (ValueError, TypeError):
+            return False
+        if not 0 < epoch - previous <= self.max_marks:
+            return False
+        for i in xrange(previous + 1, epoch + 1):
+            if self.table.get(self._mark(i)) is None:
+                return False
+        return True
+
+    def get(self, key, default=None):
+        if self.is_result_key(key):
+            return self.backend.get(key, default)
+        self.start_agent()
+        version, writes = self.table.version, self.table.writes
+        value = self._lookup(key, version)
+        if value is MISSING:
+            value = self.backend.get(key, MISSING)
+            if value is MISSING:
+                return default
+            self._store_read({key: value}, version, writes)
+        return value
+
+    def get_many(self, keys):
+        self.start_agent()
+        version, writes = self.table.version, self.table.writes
+        results = {}
+        lookup = []
+        for key in keys:
+            if not self.is_result_key(key):
+                value = self._lookup(key, version)
+                if value is not MISSING:
+                    results[key] = value
+                    continue
+            lookup.append(key)
+        if lookup:
+            found = self.backend.get_many(lookup)
+            results.update(found)
+            self._store_read(self._generations(found), version, writes)
+        return results
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=None):
+        self.backend.set_many(data, timeout)
+        generations = self._generations(data)
+        if generations:
+            # counted first, so that reads racing this write don't keep
+            # what they read
+            self.table.count_write()
+            self._store(generations, self.table.version)
+            self.bump_epoch()
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        self.backend.delete_many(keys)
+        self.table.count_write()
+        for key in keys:
+            self.table.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+        self.table.bump_version()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': lookups and float(self.hits) / lookups,
+            'version': self.table.version,
+        }
+
+
+class GenerationAgent(threading.Thread):
+    """
+    Keeps the version of a ``SharedGenerationCache``'s table in step with
+    the epoch in the backend, a count incremented on every write.  Every
+    process runs one, but only the one holding the lock on
+    ``<table path>.lock`` polls;  the others wait to take over if its
+    process exits.
+
+    ``poll`` can also be called directly, for instance by something that
+    receives invalidation messages, to pick up changes straight away.
+    """
+
+    def __init__(self, tier, interval):
+        super(GenerationAgent, self).__init__(name='johnny-generation-agent')
+        self.daemon = True
+        self.tier = tier
+        self.interval = interval
+        self.epoch = MISSING
+        self.finished = threading.Event()
+        self.lock_path = tier.table.path + '.lock'
+        # fails here, rather than in the thread, if the lock file is unsafe
+        os.close(open_private(self.lock_path))
+
+    def poll(self):
+        """Bumps the table's version if the epoch has changed since the
+        last poll, other than by writes on this host.  Returns True if it
+        did."""
+        epoch = self.tier.backend.get(self.tier.epoch_key)
+        if epoch == self.epoch:
+            return False
+        previous, self.epoch = self.epoch, epoch
+        if self.tier.written_here(previous, epoch):
+            return False
+        self.tier.table.bump_version()
+        return True
+
+    def run(self):
+        fd = open_private(self.lock_path)
+        try:
+            locked = False
+            while not self.finished.isSet():
+                if not locked:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        locked = True
+                    except IOError:
+                        pass
+                if locked:
+                    try:
+                        self.poll()
+                    except Exception:
+                        # the backend is unreachable;  try again next time
+                        pass
+                self.finished.wait(self.interval)
+        finally:
+            os.close(fd)
+
+    def stop(self):
+        self.finished.set()
+
+
+def stack(backend, keygen):
+    """Wraps ``backend`` in the tiers enabled in johnny's settings."""
+    results = settings._get_result_backend()
+    if results is not None:
+        backend = KeyRouter(backend, results, keygen.is_query_key)
+    if settings.CIRCUIT_BREAKER is not None:
+        backend = CircuitBreaker(backend, keygen.is_query_key,
+                                 new_generation=keygen.random_generator,
+                                 **settings.CIRCUIT_BREAKER)
+    if settings.GENERATION_REPLICAS:
+        replicas = {}
+        for table, count in settings.GENERATION_REPLICAS.iteritems():
+            for db in settings.DB_CACHE_KEYS:
+                replicas[keygen.gen_table_key(table, db)] = count
+        backend = ReplicatedGenerations(backend, replicas)
+    if settings.SHARED_GENERATION_PATH:
+        from johnny.shm import SharedTable
+        table = SharedTable(settings.SHARED_GENERATION_PATH,
+                            settings.SHARED_GENERATION_SIZE, 128)
+        backend = SharedGenerationCache(
+            backend, keygen.is_query_key, table,
+            '%s_generation_epoch' % keygen.prefix,
+            settings.SHARED_GENERATION_INTERVAL,
+            settings.MIDDLEWARE_SECONDS)
+    if settings.SHARED_CACHE_PATH:
+        from johnny.shm import SharedTable
+        table = SharedTable(settings.SHARED_CACHE_PATH,
+                            settings.SHARED_CACHE_SIZE,
+                            settings.SHARED_CACHE_SLOT_SIZE)
+        backend = SharedResultCache(backend, keygen.is_query_key, table)
+    if settings.PROCESS_CACHE_SIZE:
+        backend = LocalResultCache(backend, keygen.is_query_key,
+                                   settings.PROCESS_CACHE_SIZE)
+    return backend
+
+
+def get_stats(backend):
+    """Returns the stats of every tier above ``backend``, by class name."""
+    stats = {}
+    while isinstance(backend, CacheTier):
+        stats[backend.__class__.__name__] = backend.stats()
+        backend = backend.backend
+    return stats
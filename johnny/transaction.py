@@ -1,11 +1,19 @@
+try:
+    # gevent's local is per greenlet, and per thread outside of greenlets.
+    from gevent.local import local
+except ImportError:
+    from threading import local
+
 import django
 from django.db import transaction as django_transaction
 from django.db import connection
 try:
     from django.db import DEFAULT_DB_ALIAS
 except:
-    DEFUALT_DB_ALIAS = None
+    DEFAULT_DB_ALIAS = None
 
+from johnny import tiers
+from johnny.datastructures import LRUCache
 from johnny.decorators import wraps, available_attrs
 
 
@@ -24,127 +32,169 @@ class TransactionCache(object):
     Save points are also handled.
     '''
     NOT_THERE = object()
+    UNSET = object()
 
-    def __init__(self, cache_backend):
+    def __init__(self, cache_backend, local_cache=None):
         from johnny import cache, settings
 
         self.timeout = settings.MIDDLEWARE_SECONDS
         self.cache_backend = cache_backend
 
-        # The cache is made up of many layers of dictionaries.
-        # Each layer's values supersede those of the layers below.
-        #
-        # The first layer is the local cache which stores any
-        # results retreived from the cache_backend.
-        #
-        # The second layer is keeps any changes made during a transaction.
-        #
-        # Subsequent layers are used by savepoints, so the changes can be
-        # dropped on savepoint rollback.
-        self.local_cache = {}
-        self.stack = [{}, self.local_cache]
+        # The local cache stores any results retreived from the
+        # cache_backend, up to LOCAL_CACHE_SIZE bytes if that is set.
+        # Only these reads are ever evicted, never the changes below.
+        # It may be shared with other TransactionCaches that read the
+        # same keys.
+        if local_cache is None:
+            local_cache = LRUCache(settings.LOCAL_CACHE_SIZE)
+        self.local_cache = local_cache
+        # Any changes made during the transaction supersede the local
+        # cache.  Savepoints don't add layers of their own;  instead
+        # each keeps an undo log of the previous dirty value of every
+        # key changed since it was created (UNSET if there was none),
+        # so the cost of every operation is proportional to the keys
+        # involved rather than the savepoint depth.
+        self.dirty = {}
+        # (name, undo log) pairs, oldest first.
         self.savepoints = []
 
     def get(self, key, default=None):
-        for layer in self.stack:
-            if key in layer:
-                value = layer[key]
-                if value is self.NOT_THERE:
-                    return default
-                return value
-        value = self.cache_backend.get(key, self.NOT_THERE)
-        self.local_cache[key] = value
+        if key in self.dirty:
+            value = self.dirty[key]
+        else:
+            value = self.local_cache.get(key, self.UNSET)
+            if value is self.UNSET:
+                value = self.cache_backend.get(key, self.NOT_THERE)
+                self.local_cache[key] = value
         if value is self.NOT_THERE:
             return default
         return value
 
     def get_many(self, keys):
+        dirty, local_cache = self.dirty, self.local_cache
+        UNSET, NOT_THERE = self.UNSET, self.NOT_THERE
         results = {}
         lookup = []
         for key in keys:
-            for layer in self.stack:
-                if key in layer:
-                    value = layer[key]
-                    if value is self.NOT_THERE:
-                        break
-                    results[key] = value
-                    break
+            if key in dirty:
+                value = dirty[key]
             else:
-                lookup.append(key)
+                value = local_cache.get(key, UNSET)
+                if value is UNSET:
+                    lookup.append(key)
+                    continue
+            if value is not NOT_THERE:
+                results[key] = value
         if lookup:
             vars = self.cache_backend.get_many(lookup)
             for key in lookup:
                 if key in vars:
-                    self.local_cache[key] = vars[key]
+                    local_cache[key] = vars[key]
                     results[key] = vars[key]
                 else:
-                    self.local_cache[key] = self.NOT_THERE
+                    local_cache[key] = NOT_THERE
         return results
 
+    @property
+    def local_size(self):
+        """The approximate size in bytes of the local read cache."""
+        return self.local_cache.size
+
+    def _write(self, key, value):
+        if self.savepoints:
+            undo = self.savepoints[-1][1]
+            if key not in undo:
+                undo[key] = self.dirty.get(key, self.UNSET)
+        self.dirty[key] = value
+
     def set(self, key, value, timeout=None):
-        self.stack[0][key] = value
+        if self.savepoints:
+            self._write(key, value)
+        else:
+            self.dirty[key] = value
 
     def set_many(self, vars, timeout=None):
-        self.stack[0].update(vars)
+        for key, value in vars.iteritems():
+            self._write(key, value)
 
     def delete(self, key):
-        self.stack[0][key] = self.NOT_THERE
+        self._write(key, self.NOT_THERE)
 
     def delete_many(self, keys):
         for key in keys:
-            self.stack[0][key] = self.NOT_THERE
+            self._write(key, self.NOT_THERE)
 
     def rollback(self):
+        # Only the transaction's own changes are discarded.  The local
+        # read cache holds values fetched from the cache_backend, which
+        # a rollback doesn't change, so it is kept apart from any keys
+        # the transaction wrote over.
+        for key in self.dirty:
+            self.local_cache.pop(key, None)
+        self._reset()
+
+    def clear(self):
+        """Discards the transaction's changes and the local read cache."""
         self.local_cache.clear()
-        self.stack[:-1] = [{}]
+        self._reset()
 
-    def commit(self):
-        # Send the changes on the stack, not including the first layer
-        # as that is the local read cache.
-        stack = self.stack[:-1]
-        stack.reverse()
+    def _reset(self):
+        self.dirty = {}
+        del self.savepoints[:]
 
+    def commit(self):
+        # Send the changes, not including the local read cache.
         vars = {}
-        for layer in stack:
-            vars.update(layer)
-
         deleted = []
-        for key, value in vars.iteritems():
+        for key, value in self.dirty.iteritems():
             if value is self.NOT_THERE:
                 deleted.append(key)
-        for key in deleted:
-            del vars[key]
+            else:
+                vars[key] = value
 
         if vars:
             self.cache_backend.set_many(vars, self.timeout)
         if deleted:
             self.cache_backend.delete_many(deleted)
 
-        self.rollback()
+        # Other processes may have committed since anything was read, and
+        # the local read cache can outlive a request (in a worker, say),
+        # so it's refreshed from the cache_backend after every commit.
+        self.clear()
 
     def savepoint(self, name):
-        self.savepoints.insert(0, (name, len(self.stack)))
-        self.stack.insert(0, {})
+        self.savepoints.append((name, {}))
 
     def rollback_savepoint(self, name):
-        sp_idx, stack_idx = self._find_savepoint(name)
-        del self.savepoints[:sp_idx+1]
-        del self.stack[:-stack_idx]
+        sp_idx = self._find_savepoint(name)
+        # Undo the newest changes first, so each key ends up with the
+        # value it had when the savepoint was created.
+        for sp, undo in reversed(self.savepoints[sp_idx:]):
+            for key, value in undo.iteritems():
+                if value is self.UNSET:
+                    self.dirty.pop(key, None)
+                else:
+                    self.dirty[key] = value
+        del self.savepoints[sp_idx:]
 
     def commit_savepoint(self, name):
         # Commiting a savepoint doesn't do anything to the data,
-        # it just removes the savepoint information.
-        # It is reasonable to combine all the layers up to the
-        # savepoint into a single dictionary, but this isn't
-        # neccessary and may in fact be slower than leaving it
-        # alone.
-        sp_idx, stack_idx = self._find_savepoint(name)
-        del self.savepoints[:sp_idx+1]
+        # it just removes the savepoint information.  The changes made
+        # since then now belong to the enclosing savepoint, if any, so
+        # its undo log takes the oldest previous values of those keys.
+        sp_idx = self._find_savepoint(name)
+        if sp_idx:
+            enclosing = self.savepoints[sp_idx - 1][1]
+            for sp, undo in self.savepoints[sp_idx:]:
+                for key, value in undo.iteritems():
+                    if key not in enclosing:
+                        enclosing[key] = value
+        del self.savepoints[sp_idx:]
 
     def _find_savepoint(self, name):
-        for sp_idx, (sp, stack_idx) in enumerate(self.savepoints):
-            if sp == name:
-                return sp_idx, stack_idx
+        for sp_idx in xrange(len(self.savepoints) - 1, -1, -1):
+            if self.savepoints[sp_idx][0] == name:
+                return sp_idx
         raise IndexError()
 
 
@@ -152,6 +202,13 @@ class TransactionManager(object):
     """
     TransactionManager hooks a TransactionCache into Django's
     transaction system.
+
+    Each thread (or greenlet, when gevent is installed) gets its own
+    TransactionCache for each database alias, since transactions and
+    their savepoints belong to the thread and connection running them.
+    Aliases with the same ``JOHNNY_CACHE_KEY`` read the same keys, so
+    their TransactionCaches share one local read cache, which a commit
+    through any of them clears.
     """
     _patched_var = False
 
@@ -161,21 +218,68 @@ class TransactionManager(object):
         self.timeout = settings.MIDDLEWARE_SECONDS
         self.prefix = settings.MIDDLEWARE_KEY_PREFIX
 
-        self.cache_backend = cache_backend
-        self.tx_cache = TransactionCache(self.cache_backend)
         self.keygen = keygen(self.prefix)
+        self.cache_backend = tiers.stack(cache_backend, self.keygen)
+        self._is_open = getattr(self.cache_backend, 'is_open', None)
+        self._local = local()
         self._originals = {}
 
+    def get_tx_cache(self, using=None):
+        """Returns this thread's TransactionCache for the ``using`` alias."""
+        if using is None:
+            using = DEFAULT_DB_ALIAS
+        try:
+            caches = self._local.caches
+        except AttributeError:
+            caches = self._local.caches = {}
+            self._local.reads = {}
+        try:
+            return caches[using]
+        except KeyError:
+            from johnny import settings
+            cache_key = settings.DB_CACHE_KEYS.get(using, using)
+            reads = self._local.reads
+            if cache_key not in reads:
+                reads[cache_key] = LRUCache(settings.LOCAL_CACHE_SIZE)
+            tx_cache = caches[using] = TransactionCache(self.cache_backend,
+                                                        reads[cache_key])
+            return tx_cache
+
+    @property
+    def tx_cache(self):
+        return self.get_tx_cache()
+
+    def cache_stats(self):
+        """Returns the stats of the cache tiers in use, by class name."""
+        return tiers.get_stats(self.cache_backend)
+
+    def is_bypassed(self):
+        """Returns True while a circuit breaker has taken the cache backend
+        out of use, in which case queries shouldn't be cached."""
+        return self._is_open is not None and self._is_open()
+
+    def local_size(self):
+        """Returns the approximate size in bytes of the local read caches
+        of this thread's TransactionCaches."""
+        reads = getattr(self._local, 'reads', {})
+        return sum([r.size for r in reads.values()])
+
+    def clear(self):
+        """Discards this thread's TransactionCaches for every alias,
+        including anything they have read from the cache backend."""
+        self._local.caches = {}
+        self._local.reads = {}
+
     def is_managed(self, using=None):
         if django.VERSION[1] < 2:
             return django_transaction.is_managed()
         return django_transaction.is_managed(using=using)
 
     def get(self, key, default=None, using=None):
-        return self.tx_cache.get(key, default)
+        return self.get_tx_cache(using).get(key, default)
 
     def get_many(self, keys, using=None):
-        return self.tx_cache.get_many(keys)
+        return self.get_tx_cache(using).get_many(keys)
 
     def set(self, key, val, timeout=None, using=None):
         """
@@ -187,15 +291,42 @@ class TransactionManager(object):
         if timeout is None:
             timeout = self.timeout
         if self.is_managed(using=using) and self._patched_var:
-            self.tx_cache.set(key, val, timeout)
+            self.get_tx_cache(using).set(key, val, timeout)
         else:
             self.cache_backend.set(key, val, timeout)
 
+    def set_many(self, data, timeout=None, using=None):
+        if timeout is None:
+            timeout = self.timeout
+        if self.is_managed(using=using) and self._patched_var:
+            self.get_tx_cache(using).set_many(data, timeout)
+        else:
+            self.cache_backend.set_many(data, timeout)
+
+    @property
+    def get_or_add_many(self):
+        """
+        Stores the values in ``data`` for the keys that have none, and
+        returns the values all of them hold afterwards, atomically and
+        outside of any transaction.  Only there if the cache backend
+        provides ``get_or_add_many``.
+        """
+        if getattr(self.cache_backend, 'get_or_add_many', None) is None:
+            raise AttributeError('get_or_add_many')
+        return self._get_or_add_many
+
+    def _get_or_add_many(self, data, timeout=None, using=None):
+        if timeout is None:
+            timeout = self.timeout
+        results = self.cache_backend.get_or_add_many(data, timeout)
+        self.get_tx_cache(using).local_cache.update(results)
+        return results
+
     def commit(self, using=None):
-        self.tx_cache.commit()
+        self.get_tx_cache(using).commit()
 
     def rollback(self, using=None):
-        self.tx_cache.rollback()
+        self.get_tx_cache(using).rollback()
 
     def _patched(self, original, commit=True, unless_managed=False):
         @wraps(original, assigned=available_attrs(original))
@@ -216,13 +347,13 @@ class TransactionManager(object):
         return connection.features.uses_savepoints
 
     def _create_savepoint(self, sid, using=None):
-        self.tx_cache.savepoint(sid)
+        self.get_tx_cache(using).savepoint(sid)
 
     def _rollback_savepoint(self, sid, using=None):
-        self.tx_cache.rollback_savepoint(sid)
+        self.get_tx_cache(using).rollback_savepoint(sid)
 
     def _commit_savepoint(self, sid, using=None):
-        self.tx_cache.commit_savepoint(sid)
+        self.get_tx_cache(using).commit_savepoint(sid)
 
     def _savepoint(self, original):
         @wraps(original, assigned=available_attrs(original))